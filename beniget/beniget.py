@@ -1,5 +1,6 @@
-from collections import defaultdict, deque
+from collections import defaultdict
 from contextlib import contextmanager
+from operator import attrgetter, is_
 import sys
 import os.path
 
@@ -8,15 +9,122 @@ import gast as ast
 
 from .ordered_set import ordered_set
 
-_ClassOrFunction = set(('ClassDef', 'FunctionDef', 'AsyncFunctionDef'))
-_Comp = set(('DictComp', 'ListComp', 'SetComp', 'GeneratorExp'))
-_ClosedScopes = set(('FunctionDef', 'AsyncFunctionDef',
-                  'Lambda', 'DictComp', 'ListComp',
-                  'SetComp', 'GeneratorExp', 'def695'))
-_TypeVarLike = set(('TypeVar', 'TypeVarTuple', 'ParamSpec'))
-_HasName = set((*_ClassOrFunction, *_TypeVarLike))
+# The analysis is dominated by visitor dispatch and dict/set updates on the
+# node graph: there is no numeric kernel for Numba to compile. Keep the hot
+# paths lean (type sets below, dispatch table in _NodeVisitor) and avoid
+# CPython-only tricks (id() keyed caches, refcounts) so PyPy stays an option.
 
-class Ancestors(ast.NodeVisitor):
+def _node_types(*names):
+    """
+    Returns the set of gast and standard library node types with the given
+    names, so node kinds can be checked with ``type(node) in types``.
+    """
+    return frozenset(getattr(mod, name) for mod in (ast, _ast) for name in names
+                     if hasattr(mod, name))
+
+_ClassOrFunction = _node_types('ClassDef', 'FunctionDef', 'AsyncFunctionDef')
+_Comp = _node_types('DictComp', 'ListComp', 'SetComp', 'GeneratorExp')
+_TypeVarLike = _node_types('TypeVar', 'TypeVarTuple', 'ParamSpec')
+_HasName = _ClassOrFunction | _TypeVarLike
+_ClassDef = _node_types('ClassDef')
+_Module = _node_types('Module')
+_Name = _node_types('Name')
+_Attribute = _node_types('Attribute')
+_Alias = _node_types('alias')
+_Import = _node_types('Import')
+_ImportFrom = _node_types('ImportFrom')
+_Terminators = _node_types('Break', 'Continue', 'Raise')
+_Store = _node_types('Store')
+# shared context temporarily set on destructured names, never kept by a node
+_TMP_STORE = ast.Store()
+_NamedExpr = _node_types('NamedExpr')
+_TypeVar = _node_types('TypeVar')
+_ListOrTuple = _node_types('List', 'Tuple')
+_SubscriptStarredOrAttribute = _node_types('Subscript', 'Starred', 'Attribute')
+# nodes that cannot appear in annotation-like scopes
+_AnnotationIllegal = _node_types('NamedExpr', 'Yield', 'YieldFrom', 'Await')
+# nodes that cannot appear in annotation scopes within a class scope
+_NestedScopes = _Comp | _node_types('Lambda')
+_Load = _node_types('Load')
+_StoreOrParam = _node_types('Store', 'Param')
+_LoadOrDel = _node_types('Load', 'Del')
+# nodes that may bind a name or reshape the definitions of an enclosing loop
+_Binders = _node_types('FunctionDef', 'AsyncFunctionDef', 'ClassDef',
+                       'Import', 'ImportFrom', 'ExceptHandler', 'Global',
+                       'Nonlocal', 'Break', 'Continue', 'MatchAs',
+                       'MatchStar', 'MatchMapping', 'TypeAlias')
+_Expr = _node_types('Expr')
+_Constant = _node_types('Constant')
+# before Python 3.8, string literals are not Constant nodes
+_Str = _node_types('Str') if sys.version_info < (3, 8) else frozenset()
+
+# mapping from node type to the names of the fields that may hold child nodes
+_CHILD_FIELDS = {}
+
+_ScalarTypes = (str, bytes, int, float, complex, bool, type(Ellipsis))
+
+def _child_fields(node):
+    """
+    Returns the names of the fields of *node* that may hold AST nodes.
+
+    The result is computed the first time a node type is met, fields holding
+    scalar values (identifiers, constants, import levels...) are discarded.
+    """
+    try:
+        return _CHILD_FIELDS[type(node)]
+    except KeyError:
+        fields = _CHILD_FIELDS[type(node)] = tuple(
+            f for f in node._fields
+            if not isinstance(getattr(node, f, None), _ScalarTypes))
+        return fields
+
+class _NodeVisitor(ast.NodeVisitor):
+    """
+    Node visitor that dispatches on ``type(node)`` with a per-class table
+    instead of formatting and looking up ``'visit_' + classname`` at each visit.
+
+    The table is filled the first time a node type is met, so it works
+    for gast nodes, standard library nodes and custom nodes alike.
+    The generic visit only looks at the fields that may hold child nodes.
+    """
+    _VISITORS = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._VISITORS = {}
+
+    @classmethod
+    def _get_visitor(cls, nodetype):
+        """
+        Returns the visitor function for the given node type,
+        it must be called with the visitor instance as first argument.
+        """
+        try:
+            return cls._VISITORS[nodetype]
+        except KeyError:
+            visitor = cls._VISITORS[nodetype] = getattr(
+                cls, 'visit_' + nodetype.__name__, cls.generic_visit)
+            return visitor
+
+    def visit(self, node):
+        try:
+            visitor = self._VISITORS[type(node)]
+        except KeyError:
+            visitor = self._get_visitor(type(node))
+        return visitor(self, node)
+
+    def generic_visit(self, node):
+        visit = self.visit
+        for field in _child_fields(node):
+            value = getattr(node, field, None)
+            if type(value) is list:
+                for item in value:
+                    if isinstance(item, _ast.AST):
+                        visit(item)
+            elif isinstance(value, _ast.AST):
+                visit(value)
+
+class Ancestors(_NodeVisitor):
     """
     Build the ancestor tree, that associates a node to the list of node visited
     from the root node (the Module) to the current node
@@ -50,25 +158,37 @@ class Ancestors(ast.NodeVisitor):
     """
 
     def __init__(self):
-        self._parents = dict()
-        self._current = list()
+        # mapping from a node to its direct parent, None for the root node
+        self._parent = dict()
+        self._current = None
 
     def generic_visit(self, node):
-        self._parents[node] = list(self._current)
-        self._current.append(node)
+        self._parent[node] = current = self._current
+        self._current = node
         super().generic_visit(node)
-        self._current.pop()
+        self._current = current
 
     def parent(self, node):
-        return self._parents[node][-1]
+        parent = self._parent[node]
+        if parent is None:
+            raise IndexError("{} has no parent".format(node))
+        return parent
 
     def parents(self, node):
-        return self._parents[node]
+        parents = []
+        parent = self._parent[node]
+        while parent is not None:
+            parents.append(parent)
+            parent = self._parent[parent]
+        parents.reverse()
+        return parents
 
     def parentInstance(self, node, cls):
-        for n in reversed(self._parents[node]):
-            if isinstance(n, cls):
-                return n
+        parent = self._parent[node]
+        while parent is not None:
+            if isinstance(parent, cls):
+                return parent
+            parent = self._parent[parent]
         raise ValueError("{} has no parent of type {}".format(node, cls))
 
     def parentFunction(self, node):
@@ -110,6 +230,41 @@ class ImportInfo:
 # The MIT License (MIT)
 # Copyright (c) 2017 Jelle Zijlstra
 # Adapted from the project typeshed_client.
+def _import_from_module(node, modname, is_package):
+    """
+    Returns the name of the module the given ``ImportFrom`` node imports from.
+    """
+    current_module = tuple(modname.split("."))
+
+    if node.module is None:
+        module = ()
+    else:
+        module = tuple(node.module.split("."))
+    
+    if not node.level:
+        source_module = module
+    else:
+        # parse relative imports
+        if node.level == 1:
+            if is_package:
+                relative_module = current_module
+            else:
+                relative_module = current_module[:-1]
+        else:
+            if is_package:
+                relative_module = current_module[: 1 - node.level]
+            else:
+                relative_module = current_module[: -node.level]
+
+        if not relative_module:
+            # We don't raise errors when an relative import makes no sens, 
+            # we simply pad the name with dots.
+            relative_module = ("",) * node.level
+
+        source_module = relative_module + module
+
+    return ".".join(source_module)
+
 def parse_import(node, modname, is_package=False):
     """
     Parse the given import node into a mapping of aliases to `ImportInfo`.
@@ -121,8 +276,8 @@ def parse_import(node, modname, is_package=False):
     """
     result = {}
 
-    typename = type(node).__name__
-    if typename == 'Import':
+    nodetype = type(node)
+    if nodetype in _Import:
         for al in node.names:
             if al.asname:
                 result[al] = ImportInfo(orgmodule=al.name)
@@ -133,63 +288,16 @@ def parse_import(node, modname, is_package=False):
                 # not the dependencies.
                 result[al] = ImportInfo(orgmodule=al.name.split(".", 1)[0])
     
-    elif typename == 'ImportFrom':
-        current_module = tuple(modname.split("."))
-
-        if node.module is None:
-            module = ()
-        else:
-            module = tuple(node.module.split("."))
-        
-        if not node.level:
-            source_module = module
-        else:
-            # parse relative imports
-            if node.level == 1:
-                if is_package:
-                    relative_module = current_module
-                else:
-                    relative_module = current_module[:-1]
-            else:
-                if is_package:
-                    relative_module = current_module[: 1 - node.level]
-                else:
-                    relative_module = current_module[: -node.level]
-
-            if not relative_module:
-                # We don't raise errors when an relative import makes no sens, 
-                # we simply pad the name with dots.
-                relative_module = ("",) * node.level
-
-            source_module = relative_module + module
-
+    elif nodetype in _ImportFrom:
+        orgmodule = _import_from_module(node, modname, is_package)
         for alias in node.names:
-            result[alias] = ImportInfo(
-                orgmodule=".".join(source_module), orgname=alias.name
-            )
+            result[alias] = ImportInfo(orgmodule=orgmodule, orgname=alias.name)
 
     else:
         raise TypeError('unexpected node type: {}'.format(type(node)))
     
     return result
 
-_novalue = object()
-@contextmanager
-def _setattrs(obj, **attrs):
-    """
-    Provide cheap attribute polymorphism.
-    """
-    old_values = {}
-    for k, v in attrs.items():
-        old_values[k] = getattr(obj, k, _novalue)
-        setattr(obj, k, v)
-    yield 
-    for k, v in old_values.items():
-        if v is _novalue:
-            delattr(obj, k)
-        else:
-            setattr(obj, k, v)
-
 class Def(object):
     """
     Model a definition, either named or unnamed, and its users.
@@ -199,7 +307,9 @@ class Def(object):
 
     def __init__(self, node):
         self.node = node
-        self._users = ordered_set()
+        # insertion-ordered set of users, values are unused.
+        # Many definitions are never used, so it's only created on demand.
+        self._users = None
         self.islive = True
         """
         Whether this definition might reach the final block of it's scope.
@@ -210,38 +320,33 @@ class Def(object):
 
     def add_user(self, node):
         assert isinstance(node, Def), node
-        self._users.add(node)
+        users = self._users
+        if users is None:
+            users = self._users = {}
+        users[node] = None
 
     def name(self):
         """
         If the node associated to this Def has a name, returns this name.
         Otherwise returns its type
         """
-        typename = type(self.node).__name__
-        if typename in _HasName:
-            return self.node.name
-        elif typename == 'Name':
-            return self.node.id
-        elif typename == 'alias':
-            base = self.node.name.split(".", 1)[0]
-            return self.node.asname or base
-        elif typename in ('MatchStar', 'MatchAs') and self.node.name:
-            return self.node.name
-        elif typename == 'MatchMapping' and self.node.rest:
-            return self.node.rest
-        elif typename == 'arg':
-            return self.node.arg
-        elif typename == 'ExceptHandler' and self.node.name:
-            return self.node.name
+        nodetype = type(self.node)
+        getter = _def_name_getters.get(nodetype)
+        if getter is not None:
+            name = getter(self.node)
+            if name:
+                return name
         elif isinstance(self.node, tuple):
             return self.node[1]
-        return typename
+        return nodetype.__name__
 
     def users(self):
         """
-        The list of ast entity that holds a reference to this node
+        The list of ast entity that holds a reference to this node,
+        as a read-only ordered_set.
         """
-        return self._users
+        users = self._users
+        return ordered_set() if users is None else ordered_set._view(users)
 
     def __repr__(self):
         return self._repr({})
@@ -253,7 +358,7 @@ class Def(object):
             nodes[self] = len(nodes)
             return "{} -> ({})".format(
                 self.node, ", ".join(u._repr(nodes.copy())
-                                     for u in self._users)
+                                     for u in self.users())
             )
 
     def __str__(self):
@@ -266,10 +371,38 @@ class Def(object):
             nodes[self] = len(nodes)
             return "{} -> ({})".format(
                 self.name(), ", ".join(u._str(nodes.copy())
-                                       for u in self._users)
+                                       for u in self.users())
             )
 
 
+def _alias_name(node):
+    return node.asname or _import_base(node.name)
+
+def _import_base(name):
+    """
+    Returns the name bound by ``import <name>``.
+
+    The identifiers from the parser are interned, but the ones we slice out
+    of dotted names are not: intern them since they are used as keys
+    in the definitions mappings.
+    """
+    return sys.intern(name.split(".", 1)[0])
+
+# mapping from node type to a function returning the name bound by the node,
+# the name may be None for nodes that do not always bind one.
+_def_name_getters = {}
+for _nodetype in _HasName | _node_types('MatchStar', 'MatchAs', 'ExceptHandler'):
+    _def_name_getters[_nodetype] = attrgetter('name')
+for _nodetype in _Name:
+    _def_name_getters[_nodetype] = attrgetter('id')
+for _nodetype in _Alias:
+    _def_name_getters[_nodetype] = _alias_name
+for _nodetype in _node_types('MatchMapping'):
+    _def_name_getters[_nodetype] = attrgetter('rest')
+for _nodetype in _node_types('arg'):
+    _def_name_getters[_nodetype] = attrgetter('arg')
+del _nodetype
+
 import builtins
 BuiltinsSrc = builtins.__dict__
 
@@ -283,15 +416,7 @@ def collect_future_imports(node):
     """
     Returns a set of future imports names for the given ast module.
     """
-    assert type(node).__name__ == 'Module'
-    cf = _CollectFutureImports()
-    cf.visit(node)
-    return cf.FutureImports
-
-class _StopTraversal(Exception):
-    pass
-
-class _CollectFutureImports(ast.NodeVisitor):
+    assert type(node) in _Module
     # A future statement must appear near the top of the module.
     # The only lines that can appear before a future statement are:
     # - the module docstring (if any),
@@ -299,35 +424,22 @@ class _CollectFutureImports(ast.NodeVisitor):
     # - blank lines, and
     # - other future statements.
     # as soon as we're visiting something else, we can stop the visit.
-    def __init__(self):
-        self.FutureImports = set() #type:set[str]
-
-    def visit_Module(self, node):
-        for child in node.body:
-            try:
-                self.visit(child)
-            except _StopTraversal:
-                break
-
-    def visit_ImportFrom(self, node):
-        if node.level or node.module != '__future__':
-            raise _StopTraversal()
-        self.FutureImports.update((al.name for al in node.names))
-
-    def visit_Expr(self, node):
-        self.visit(node.value)
-
-    def visit_Constant(self, node):
-        if not isinstance(node.value, str):
-            raise _StopTraversal()
-
-    def generic_visit(self, node):
-        raise _StopTraversal()
-
-    def visit_Str(self, node):
-        pass
+    future_imports = set() #type:set[str]
+    for stmt in node.body:
+        stmttype = type(stmt)
+        if stmttype in _Expr:
+            value = stmt.value
+            if (type(value) in _Constant and isinstance(value.value, str)
+                    or type(value) in _Str):
+                continue
+        elif stmttype in _ImportFrom:
+            if not stmt.level and stmt.module == '__future__':
+                future_imports.update(al.name for al in stmt.names)
+                continue
+        break
+    return future_imports
 
-class CollectLocals(ast.NodeVisitor):
+class CollectLocals(_NodeVisitor):
     def __init__(self):
         self.Locals = set()
         self.NonLocals = set()
@@ -341,13 +453,15 @@ class CollectLocals(ast.NodeVisitor):
     visit_ClassDef = visit_FunctionDef
 
     def visit_Nonlocal(self, node):
-        self.NonLocals.update(name for name in node.names)
+        self.NonLocals.update(node.names)
 
     visit_Global = visit_Nonlocal
 
     def visit_Name(self, node):
-        if type(node.ctx).__name__ == 'Store' and node.id not in self.NonLocals:
-            self.Locals.add(node.id)
+        if type(node.ctx) in _Store:
+            name = node.id
+            if not self.NonLocals or name not in self.NonLocals:
+                self.Locals.add(name)
 
     def skip(self, _):
         pass
@@ -359,7 +473,7 @@ class CollectLocals(ast.NodeVisitor):
 
     def visit_Import(self, node):
         for alias in node.names:
-            base = alias.name.split(".", 1)[0]
+            base = _import_base(alias.name)
             self.Locals.add(alias.asname or base)
 
     def visit_ImportFrom(self, node):
@@ -392,6 +506,11 @@ class def695(ast.stmt):
     def __init__(self, body, d):
         self.body = body # list of type params
         self.d = d # the wrapped definition node
+
+_ClosedScopes = _node_types('FunctionDef', 'AsyncFunctionDef',
+                            'Lambda', 'DictComp', 'ListComp',
+                            'SetComp', 'GeneratorExp') | {def695}
+_ClassOrDef695 = _ClassDef | {def695}
         
 def posixpath_splitparts(path):
     """
@@ -408,16 +527,12 @@ def posixpath_splitparts(path):
 
     >>> posixpath_splitparts('c:/dir/config.ini')
     ('c:', 'dir', 'config.ini')
+
+    >>> posixpath_splitparts('lib//config.ini')
+    ('lib', 'config.ini')
     """
-    sep = '/'
-    r = deque(path.split(sep))
-    # make sure the parts doesn't 
-    # start or ends with a separator or empty string.
-    while r and r[0] in (sep, ''):
-        r.popleft()
-    while r and r[-1] in (sep, ''):
-        r.pop()
-    return tuple(r)
+    # empty parts come from leading, trailing or repeated separators.
+    return tuple(filter(None, path.split('/')))
 
 def potential_module_names(filename):
     """
@@ -430,6 +545,8 @@ def potential_module_names(filename):
     ('pydoctor.pydoctor.driver', 'pydoctor.driver', 'driver')
     >>> potential_module_names('git-repos/pydoctor/pydoctor/__init__.py')
     ('pydoctor.pydoctor', 'pydoctor')
+    >>> potential_module_names('git-repos/pydoctor/pydoctor/test-data/module.py')
+    ('module',)
     """
     parts = posixpath_splitparts(filename)
     mod = os.path.splitext(parts[-1])[0]
@@ -438,17 +555,15 @@ def potential_module_names(filename):
     else:
         parts = parts[:-1] + (mod,)
     
-    names = []
-    len_parts = len(parts)
-    for i in range(len_parts):
-        p = parts[i:]
-        if not p or any(not all(sb.isidentifier() 
-                        for sb in s.split('.')) for s in p):
-            # the path cannot be converted to a module name
-            # because there are unallowed caracters.
-            continue
-        names.append('.'.join(p))
-    
+    # a suffix of the path can be converted to a module name
+    # only if none of its parts contains unallowed caracters,
+    # so we can stop at the first invalid part, starting from the end.
+    first_valid = len(parts)
+    while first_valid and all(sb.isidentifier()
+                              for sb in parts[first_valid - 1].split('.')):
+        first_valid -= 1
+
+    names = ['.'.join(parts[i:]) for i in range(first_valid, len(parts))]
     return tuple(names) or ('',)
 
 
@@ -468,15 +583,14 @@ def matches_qualname(heads, locals, imports, modnames, expr, qnames):
     :param qnames: A collection of qualified names to look for.
     """
     
-    typename = type(expr).__name__
-    if typename == 'Name':
-        try:
-            defs = lookup_annotation_name_defs(expr.id, heads, locals)
-        except Exception:
+    exprtype = type(expr)
+    if exprtype in _Name:
+        if not heads:
             return False
-        
+        defs = _lookup(expr.id, _get_annotation_lookup_scopes(heads), locals)
+
         for d in defs:
-            if type(d.node).__name__ == 'alias':
+            if type(d.node) in _Alias:
                 # the symbol is an imported name
                 import_alias = imports[d.node].target()
                 if any(import_alias == n for n in qnames):
@@ -488,20 +602,31 @@ def matches_qualname(heads, locals, imports, modnames, expr, qnames):
                 # localy defined name, but module name doesn't match
                 break
 
-    elif typename == 'Attribute':
+    elif exprtype in _Attribute:
+        # group the candidate modules by attribute name, so the
+        # attribute value is only matched once against all of them.
+        by_attr = {}
         for n in qnames:
             mod, _, _name = n.rpartition('.')
-            if mod and expr.attr == _name:
-                if matches_qualname(heads, locals, imports, modnames, expr.value, set((mod,))):
-                    return True
+            if mod:
+                by_attr.setdefault(_name, set()).add(mod)
+        mods = by_attr.get(expr.attr)
+        if mods and matches_qualname(heads, locals, imports, modnames, expr.value, mods):
+            return True
     return False
 
+# mapping from a typing name to its qualified names
+_typing_qualnames = {}
+
 def matches_typing_name(heads, locals, imports, modnames, expr, name):
-    return matches_qualname(heads, locals, imports, modnames, expr, 
-                            set(('typing.{}'.format(name), 
-                                 'typing_extensions.{}'.format(name))))
+    try:
+        qnames = _typing_qualnames[name]
+    except KeyError:
+        qnames = _typing_qualnames[name] = frozenset((
+            'typing.{}'.format(name), 'typing_extensions.{}'.format(name)))
+    return matches_qualname(heads, locals, imports, modnames, expr, qnames)
 
-class DefUseChains(ast.NodeVisitor):
+class DefUseChains(_NodeVisitor):
     """
     Module visitor that gathers two kinds of informations:
         - locals: dict[node, list[Def]], a mapping between a node and the list
@@ -553,6 +678,10 @@ class DefUseChains(ast.NodeVisitor):
         """
         self.chains = {}
         self.locals = defaultdict(list)
+        # same as self.locals, as sets for fast membership tests.
+        self._locals_index = defaultdict(set)
+        # same as self.locals, grouped by name.
+        self._locals_names = defaultdict(dict)
         # mapping from ast.alias to their ImportInfo.
         self.imports = {}
 
@@ -588,6 +717,10 @@ class DefUseChains(ast.NodeVisitor):
         # this holds a list of the functions met during body processing
         self._defered = []
 
+        # last scope state recorded in self._defered, shared by consecutive
+        # functions defined in the same block
+        self._defered_state = None
+
         # stack of mapping between an id and Names
         self._definitions = []
 
@@ -596,6 +729,9 @@ class DefUseChains(ast.NodeVisitor):
 
         # stack of variable defined with the global keywords
         self._globals = []
+        # union of the sets in self._globals, mapping each name to the number
+        # of sets it belongs to.
+        self._global_names = {}
 
         # stack of local identifiers, used to detect 'read before assign'
         self._precomputed_locals = []
@@ -621,6 +757,18 @@ class DefUseChains(ast.NodeVisitor):
         # dead code levels, it's non null for code that cannot be executed
         self._deadcode = 0
 
+        # number of warnings emitted so far
+        self._warnings = 0
+
+        # arguments of the functions whose body has not been processed yet,
+        # keyed by their ast.arguments node
+        self._arguments_cache = {}
+
+        # scopes in which annotations are looked up, computed for the scopes
+        # stack in self._annotation_scopes_key
+        self._annotation_scopes_key = None
+        self._annotation_scopes = None
+
         # attributes set in visit_Module
         self.module = None
         self.future_annotations = self.is_stub or future_annotations
@@ -643,7 +791,7 @@ class DefUseChains(ast.NodeVisitor):
             for name,defs in groupped.items()]
 
     def dump_definitions(self, node, ignore_builtins=True):
-        if type(node).__name__ == 'Module' and not ignore_builtins:
+        if type(node) in _Module and not ignore_builtins:
             builtins = {d for d in self._builtins.values()}
             return sorted(d.name()
                           for d in self.locals[node] if d not in builtins)
@@ -667,23 +815,88 @@ class DefUseChains(ast.NodeVisitor):
         else:
             return ""
 
+    def _arguments(self, args):
+        """
+        Tuple of all arguments of the given ast.arguments instance.
+
+        The result is cached until the function body is processed, which
+        walks the arguments one last time.
+        """
+        try:
+            return self._arguments_cache[args]
+        except KeyError:
+            result = self._arguments_cache[args] = tuple(_iter_arguments(args))
+            return result
+
+    def _chain_of(self, node):
+        '''
+        Returns the Def of *node*, creating it on its first visit.
+        '''
+        dnode = self.chains.get(node)
+        if dnode is None:
+            dnode = self.chains[node] = Def(node)
+        return dnode
+
     def unbound_identifier(self, name, node):
-        self.warn("unbound identifier '{}'".format(name), node)
+        self._warn("unbound identifier '{}'".format(name), node)
     
     def warn(self, msg, node):
         print("W: {}{}".format(msg, self.location(node)))
 
-    def invalid_name_lookup(self, name, scope, precomputed_locals, local_defs):
-        # We may hit the situation where we refer to a local variable which is
-        # not bound yet. This is a runtime error in Python, so we try to detec
-        # it statically.
+    def _warn(self, msg, node):
+        # count the warnings, whatever warn() does in subclasses
+        self._warnings += 1
+        self.warn(msg, node)
 
-        # not a local variable => fine
-        if name not in precomputed_locals:
-            return
+    def _loop_progress(self):
+        '''
+        Work recorded so far that a second round over a loop body would
+        record again: deferred functions, deferred annotations and warnings.
+        '''
+        return (len(self._defered), len(self._defered_annotations[-1]),
+                self._warnings)
+
+    def compute_annotation_defs(self, node, quiet=False):
+        name = node.id
+        # resolving an annotation is a bit different
+        # form other names.
+        # annotations are resolved in batches sharing the same scopes
+        key = tuple(self._scopes)
+        if key != self._annotation_scopes_key:
+            self._annotation_scopes_key = key
+            self._annotation_scopes = _get_annotation_lookup_scopes(key)
+        defs = _lookup(name, self._annotation_scopes, self.locals,
+                       names_map=self._locals_names)
+        if defs:
+            return defs
+        # fallback to regular behaviour on module scope
+        # to support names from builtins or wildcard imports.
+        return self.compute_defs(node, quiet=quiet)
+
+    def _visible_definitions(self, name):
+        """
+        Yields the definition mappings where *name* should be looked up,
+        innermost first. The mappings are computed lazily, so that outer
+        scopes are not considered at all when the name is found early.
 
-        # It's meant to be a local, but can we resolve it by a local lookup?
-        islocal = any((name in defs or '*' in defs) for defs in local_defs)
+        Names declared with the `global` keyword are not handled here.
+        """
+        definitions = self._definitions
+
+        # This includes all non-class definitions *and* the last definition.
+        # Class definitions are not included because they require fully
+        # qualified access.
+        scopes_iter = iter(reversed(self._scopes))
+        depths_iter = iter(reversed(self._scope_depths))
+        precomputed_locals_iter = iter(reversed(self._precomputed_locals))
+
+        # Keep the last scope because we could be in class scope, in which
+        # case we don't need fully qualified access.
+        lvl = depth = next(depths_iter)
+        precomputed_locals = next(precomputed_locals_iter)
+        base_scope = next(scopes_iter)
+        defs = definitions[depth:]
+        is_def695 = isinstance(base_scope, def695)
 
         # At class scope, it's ok to refer to a global even if we also have a
         # local definition for that variable. Stated other wise
@@ -693,79 +906,67 @@ class DefUseChains(ast.NodeVisitor):
         # >>> foo() # fails, a is a local referenced before being assigned
         # >>> class bar: a = a
         # >>> bar() # ok, and `bar.a is a`
-        if type(scope).__name__ in ('ClassDef', 'def695'):  # TODO: test the def695 part of this
-            top_level_definitions = self._definitions[0:-self._scope_depths[0]]
-            isglobal = any((name in top_lvl_def or '*' in top_lvl_def)
-                           for top_lvl_def in top_level_definitions)
-            return not islocal and not isglobal
-        else:
-            return not islocal
+        # TODO: test the def695 part of this
+        may_be_global = type(base_scope) in _ClassOrDef695
+        isglobal = None
 
-    def compute_annotation_defs(self, node, quiet=False):
-        name = node.id
-        # resolving an annotation is a bit different
-        # form other names.
-        try:
-            return lookup_annotation_name_defs(name, self._scopes, self.locals)
-        except LookupError:
-            # fallback to regular behaviour on module scope
-            # to support names from builtins or wildcard imports.
-            return self.compute_defs(node, quiet=quiet)
+        while True:
+            # We may hit the situation where we refer to a local variable
+            # which is not bound yet. This is a runtime error in Python, so
+            # we try to detect it statically: it's meant to be a local, but
+            # we can't resolve it by a local lookup.
+            if (name in precomputed_locals and
+                    not any((name in d or '*' in d) for d in defs)):
+                if not may_be_global:
+                    return
+                if isglobal is None:
+                    isglobal = any((name in d or '*' in d) for d in
+                                   definitions[0:-self._scope_depths[0]])
+                if not isglobal:
+                    return
+            yield from reversed(defs)
+
+            # Iterate over scopes, filtering out class scopes.
+            # If a def695 scope is immediately within a class scope, or within another def695 scope that is immediately within a class scope, 
+            # then names defined in that class scope can be accessed within the def695 scope. 
+            for scope, depth, precomputed_locals in zip(scopes_iter,
+                                                        depths_iter,
+                                                        precomputed_locals_iter):
+                lvl += depth
+                if type(scope) not in _ClassDef or is_def695:
+                    defs = definitions[lvl: lvl - depth]
+                    break
+            else:
+                return
 
     def compute_defs(self, node, quiet=False):
         '''
         Performs an actual lookup of node's id in current context, returning
-        the list of def linked to that use.
+        the list of def linked to that use, as an ordered_set or a list.
         '''
         name = node.id
         stars = []
 
         # If the `global` keyword has been used, honor it
-        if any(name in _globals for _globals in self._globals):
-            looked_up_definitions = self._definitions[0:-self._scope_depths[0]]
+        if name in self._global_names:
+            visible_definitions = self._definitions[0:-self._scope_depths[0]]
         else:
-            # List of definitions to check. This includes all non-class
-            # definitions *and* the last definition. Class definitions are not
-            # included because they require fully qualified access.
-            looked_up_definitions = []
-
-            scopes_iter = iter(reversed(self._scopes))
-            depths_iter = iter(reversed(self._scope_depths))
-            precomputed_locals_iter = iter(reversed(self._precomputed_locals))
-
-            # Keep the last scope because we could be in class scope, in which
-            # case we don't need fully qualified access.
-            lvl = depth = next(depths_iter)
-            precomputed_locals = next(precomputed_locals_iter)
-            base_scope = next(scopes_iter)
-            defs = self._definitions[depth:]
-            is_def695 = isinstance(base_scope, def695)
-            if not self.invalid_name_lookup(name, base_scope, precomputed_locals, defs):
-                looked_up_definitions.extend(reversed(defs))
-
-                # Iterate over scopes, filtering out class scopes.
-                for scope, depth, precomputed_locals in zip(scopes_iter,
-                                                            depths_iter,
-                                                            precomputed_locals_iter):
-                    # If a def695 scope is immediately within a class scope, or within another def695 scope that is immediately within a class scope, 
-                    # then names defined in that class scope can be accessed within the def695 scope. 
-                    if type(scope).__name__ != 'ClassDef' or is_def695:
-                        defs = self._definitions[lvl + depth: lvl]
-                        if self.invalid_name_lookup(name, base_scope, precomputed_locals, defs):
-                            looked_up_definitions.append(StopIteration)
-                            break
-                        looked_up_definitions.extend(reversed(defs))
-                    lvl += depth
-
-        for defs in looked_up_definitions:
-            if defs is StopIteration:
-                break
-            elif name in defs:
-                return defs[name] if not stars else stars + list(defs[name])
+            # Fast path: most names are bound in the innermost block, which
+            # always belongs to the current scope.
+            innermost = self._definitions[-1]
+            if name in innermost:
+                return ordered_set._view(innermost[name])
+            visible_definitions = self._visible_definitions(name)
+
+        for defs in visible_definitions:
+            if name in defs:
+                if stars:
+                    return stars + list(defs[name])
+                return ordered_set._view(defs[name])
             elif "*" in defs:
                 stars.extend(defs["*"])
 
-        d = self.chains.setdefault(node, Def(node))
+        d = self._chain_of(node)
 
         if self._undefs:
             self._undefs[-1][name].append((d, stars))
@@ -781,12 +982,13 @@ class DefUseChains(ast.NodeVisitor):
 
     def process_body(self, stmts):
         deadcode = False
+        # go through self.visit, subclasses may hook into it
+        visit = self.visit
         for stmt in stmts:
-            self.visit(stmt)
-            if type(stmt).__name__ in ('Break', 'Continue', 'Raise'):
-                if not deadcode:
-                    deadcode = True
-                    self._deadcode += 1
+            visit(stmt)
+            if not deadcode and type(stmt) in _Terminators:
+                deadcode = True
+                self._deadcode += 1
         if deadcode:
             self._deadcode -= 1
 
@@ -803,57 +1005,107 @@ class DefUseChains(ast.NodeVisitor):
                         self.unbound_identifier(undef_name, undef.node)
         self._undefs.pop()
 
-    @contextmanager
-    def ScopeContext(self, node):
+    # Scopes and definition contexts are entered and exited for every
+    # function, class, comprehension, branch and loop: the paired methods
+    # below are called directly in the visitors, the context managers are
+    # only kept for backward compatibility.
+
+    def _enter_scope(self, node):
         self._scopes.append(node)
         self._scope_depths.append(-1)
-        self._definitions.append(defaultdict(ordered_set))
+        self._definitions.append(defaultdict(dict))
         self._globals.append(set())
         self._precomputed_locals.append(collect_locals(node))
-        yield
+
+    def _exit_scope(self):
         self._precomputed_locals.pop()
-        self._globals.pop()
+        global_names = self._global_names
+        for name in self._globals.pop():
+            count = global_names[name] - 1
+            if count:
+                global_names[name] = count
+            else:
+                del global_names[name]
         self._definitions.pop()
         self._scope_depths.pop()
         self._scopes.pop()
 
-    CompScopeContext = ScopeContext
-
-    @contextmanager
-    def DefinitionContext(self, definitions):
+    def _enter_definitions(self, definitions):
         self._definitions.append(definitions)
         self._scope_depths[-1] -= 1
-        yield self._definitions[-1]
+        return definitions
+
+    def _exit_definitions(self):
         self._scope_depths[-1] += 1
         self._definitions.pop()
 
-
-    @contextmanager
-    def SwitchScopeContext(self, defs, scopes, scope_depths, precomputed_locals):
-        scope_depths, self._scope_depths = self._scope_depths, scope_depths
-        scopes, self._scopes = self._scopes, scopes
-        defs, self._definitions = self._definitions, defs
-        precomputed_locals, self._precomputed_locals = self._precomputed_locals, precomputed_locals
-        yield
+    def _switch_scope(self, defs, scopes, scope_depths, precomputed_locals):
+        """
+        Replace the current scope state and returns the previous one,
+        that can be restored by calling this method again.
+        """
+        previous = (self._definitions, self._scopes, self._scope_depths,
+                    self._precomputed_locals)
         self._definitions = defs
         self._scopes = scopes
         self._scope_depths = scope_depths
         self._precomputed_locals = precomputed_locals
+        return previous
+
+    @contextmanager
+    def ScopeContext(self, node):
+        self._enter_scope(node)
+        yield
+        self._exit_scope()
+
+    CompScopeContext = ScopeContext
+
+    @contextmanager
+    def DefinitionContext(self, definitions):
+        yield self._enter_definitions(definitions)
+        self._exit_definitions()
+
+    @contextmanager
+    def SwitchScopeContext(self, defs, scopes, scope_depths, precomputed_locals):
+        previous = self._switch_scope(defs, scopes, scope_depths,
+                                      precomputed_locals)
+        yield
+        self._switch_scope(*previous)
+
+    def _defer(self, node):
+        """
+        Record *node* for later processing along with a snapshot of the
+        current scope state.
+
+        The snapshot is only read back once the declarations are processed,
+        and restored stacks are left unchanged by the processing of a
+        function, so functions defined in the same block share it.
+        """
+        state = (self._definitions, self._scopes, self._scope_depths,
+                 self._precomputed_locals)
+        previous = self._defered_state
+        if previous is None or not all(
+                len(prev) == len(curr) and all(map(is_, prev, curr))
+                for prev, curr in zip(previous, state)):
+            previous = self._defered_state = tuple(map(list, state))
+        self._defered.append((node,) + previous)
 
     def process_functions_bodies(self):
         for fnode, defs, scopes, scope_depths, precomputed_locals in self._defered:
-            visitor = getattr(self,
-                              "visit_{}".format(type(fnode).__name__))
-            with self.SwitchScopeContext(defs, scopes, scope_depths, precomputed_locals):
-                visitor(fnode, step=DefinitionStep)
+            # never share the stacks being switched in with a nested function
+            self._defered_state = None
+            visitor = self._get_visitor(type(fnode))
+            previous = self._switch_scope(defs, scopes, scope_depths,
+                                          precomputed_locals)
+            visitor(self, fnode, step=DefinitionStep)
+            self._switch_scope(*previous)
 
     def process_annotations(self):
         compute_defs, self.defs = self.defs,  self.compute_annotation_defs
+        visit = self.visit
         for annnode, heads, cb in self._defered_annotations[-1]:
-            visitor = getattr(self,
-                                "visit_{}".format(type(annnode).__name__))
             currenthead, self._scopes = self._scopes, heads
-            cb(visitor(annnode)) if cb else visitor(annnode)
+            cb(visit(annnode)) if cb else visit(annnode)
             self._scopes = currenthead
         self.defs = compute_defs
 
@@ -867,37 +1119,36 @@ class DefUseChains(ast.NodeVisitor):
         self.future_annotations |= 'annotations' in futures
 
 
-        with self.ScopeContext(node):
-
-
-            self._definitions[-1].update(
-                {k: ordered_set((v,)) for k, v in self._builtins.items()}
-            )
-
-            self._defered_annotations.append([])
-            self.process_body(node.body)
+        self._enter_scope(node)
+        self._definitions[-1].update(
+            {k: {v: None} for k, v in self._builtins.items()}
+        )
 
-            # handle function bodies
-            self.process_functions_bodies()
-
-            # handle defered annotations as in from __future__ import annotations
-            self.process_annotations()
-            self._defered_annotations.pop()
-
-            # various sanity checks
-            if __debug__:
-                overloaded_builtins = set()
-                for d in self.locals[node]:
-                    name = d.name()
-                    if name in self._builtins:
-                        overloaded_builtins.add(name)
-                    assert name in self._definitions[0], (name, d.node)
+        self._defered_annotations.append([])
+        self.process_body(node.body)
 
-                nb_defs = len(self._definitions[0])
-                nb_bltns = len(self._builtins)
-                nb_overloaded_bltns = len(overloaded_builtins)
-                nb_heads = len({d.name() for d in self.locals[node]})
-                assert nb_defs == nb_heads + nb_bltns - nb_overloaded_bltns
+        # handle function bodies
+        self.process_functions_bodies()
+
+        # handle defered annotations as in from __future__ import annotations
+        self.process_annotations()
+        self._defered_annotations.pop()
+
+        # various sanity checks
+        if __debug__:
+            overloaded_builtins = set()
+            for d in self.locals[node]:
+                name = d.name()
+                if name in self._builtins:
+                    overloaded_builtins.add(name)
+                assert name in self._definitions[0], (name, d.node)
+
+            nb_defs = len(self._definitions[0])
+            nb_bltns = len(self._builtins)
+            nb_overloaded_bltns = len(overloaded_builtins)
+            nb_heads = len({d.name() for d in self.locals[node]})
+            assert nb_defs == nb_heads + nb_bltns - nb_overloaded_bltns
+        self._exit_scope()
 
         assert not self._definitions
         assert not self._defered_annotations
@@ -910,18 +1161,32 @@ class DefUseChains(ast.NodeVisitor):
             return
         
         if isinstance(dnode_or_dnodes, Def):
-            dnodes = ordered_set((dnode_or_dnodes,))
+            dnodes = {dnode_or_dnodes: None}
         else:
-            dnodes = ordered_set(dnode_or_dnodes)
+            dnodes = dict.fromkeys(dnode_or_dnodes)
+
+        definitions = self._definitions[index]
+        current = definitions.get(name)
+        if current is None:
+            # first binding of this name in this block: nothing to kill
+            definitions[name] = dnodes
+            return
+
+        # outer blocks that also bind the name, innermost first
+        alldefinitions = self._definitions
+        outer = []
+        for i in range(index % len(alldefinitions) - 1, -1, -1):
+            outer_defs = alldefinitions[i].get(name)
+            if outer_defs:
+                outer.append(outer_defs)
 
         # set the islive flag to False on killed Defs
-        for d in self._definitions[index].get(name, ()):
+        for d in current:
             if not isinstance(d.node, _ast.AST):
                 # A builtin: we never explicitely mark the builtins as killed, since 
                 # it can be easily deducted.
                 continue
-            if d in dnodes or any(d in definitions.get(name, ()) for 
-                   definitions in self._definitions[:index]):
+            if d in dnodes or any(d in outer_defs for outer_defs in outer):
                 # The definition exists in another definition context, so we can't
                 # be sure wether it's killed or not, this happens when:
                 # - a variable is conditionnaly declared (d in dnodes)
@@ -929,13 +1194,15 @@ class DefUseChains(ast.NodeVisitor):
                 continue
             d.islive = False
         
-        self._definitions[index][name] = dnodes
+        definitions[name] = dnodes
 
     @staticmethod
     def add_to_definition(definition, name, dnode_or_dnodes):
         if isinstance(dnode_or_dnodes, Def):
-            definition[name].add(dnode_or_dnodes)
+            definition[name][dnode_or_dnodes] = None
         else:
+            if not isinstance(dnode_or_dnodes, dict):
+                dnode_or_dnodes = dict.fromkeys(dnode_or_dnodes)
             definition[name].update(dnode_or_dnodes)
 
     def extend_definition(self, name, dnode_or_dnodes):
@@ -952,9 +1219,9 @@ class DefUseChains(ast.NodeVisitor):
         # it.
         if name not in self._definitions[0]:
             if isinstance(dnode_or_dnodes, Def):
-                self.locals[self.module].append(dnode_or_dnodes)
-            else:
-                self.locals[self.module].extend(dnode_or_dnodes)
+                dnode_or_dnodes = (dnode_or_dnodes,)
+            for dnode in dnode_or_dnodes:
+                self._add_local(self.module, dnode, unique=False)
         DefUseChains.add_to_definition(self._definitions[0], name,
                                        dnode_or_dnodes)
 
@@ -962,7 +1229,7 @@ class DefUseChains(ast.NodeVisitor):
         if self._deadcode:
             return
         if name not in self._definitions[0]:
-            self.locals[self.module].append(dnode)
+            self._add_local(self.module, dnode, unique=False)
         DefUseChains.add_to_definition(self._definitions[0], name, dnode)
 
     def visit_annotation(self, node):
@@ -971,14 +1238,14 @@ class DefUseChains(ast.NodeVisitor):
             self.visit(annotation)
 
     def visit_skip_annotation(self, node):
-        if type(node).__name__ == 'Name':
+        if type(node) in _Name:
             self.visit_Name(node, skip_annotation=True)
         else:
             self.visit(node)
 
     def visit_FunctionDef(self, node, step=DeclarationStep, in_def695=False):
         if step is DeclarationStep:
-            dnode = self.chains.setdefault(node, Def(node))
+            dnode = self._chain_of(node)
             self.add_to_locals(node.name, dnode)
             currentscopes = list(self._scopes)
             
@@ -1001,59 +1268,37 @@ class DefUseChains(ast.NodeVisitor):
                     self.visit_def695(def695(body=node.type_params, d=node))
                     return
             
-            parent_typename = type(currentscopes[-1 if not in_def695 else -2]).__name__
+            parent_is_class = type(currentscopes[-1 if not in_def695 else -2]) in _ClassDef
 
             if not self.future_annotations:
-                for arg in _iter_arguments(node.args):
+                for arg in self._arguments(node.args):
                     annotation = getattr(arg, 'annotation', None)
                     if annotation:
-                        if in_def695:
-                            try:
-                                _validate_annotation_body(annotation)
-                                if parent_typename == 'ClassDef':
-                                    _validate_annotation_body_within_class_scope(annotation)
-                            except SyntaxError as e :
-                                self.warn(str(e), annotation)
-                                continue
+                        if in_def695 and not self._try_validate(
+                                annotation, parent_is_class):
+                            continue
                         self.visit(annotation)
 
+                if node.returns:
+                    if not in_def695 or self._try_validate(node.returns,
+                                                           parent_is_class):
+                        self.visit(node.returns)
+
             else:
                 # annotations are to be analyzed later as well
-                if node.returns:
-                    try:
-                        _validate_annotation_body(node.returns)
-                        if in_def695 and parent_typename == 'ClassDef':
-                            _validate_annotation_body_within_class_scope(node.returns)
-                    except SyntaxError as e :
-                        self.warn(str(e), node.returns)
-                    else:
-                        self._defered_annotations[-1].append(
-                            (node.returns, currentscopes, None))
-                for arg in _iter_arguments(node.args):
+                within_class = in_def695 and parent_is_class
+                if node.returns and self._try_validate(node.returns,
+                                                       within_class):
+                    self._defered_annotations[-1].append(
+                        (node.returns, currentscopes, None))
+                for arg in self._arguments(node.args):
                     if arg.annotation:
-                        try:
-                            _validate_annotation_body(arg.annotation)
-                            if in_def695 and parent_typename == 'ClassDef':
-                                _validate_annotation_body_within_class_scope(arg.annotation)
-                        except SyntaxError as e :
-                            self.warn(str(e), arg.annotation)
+                        if not self._try_validate(arg.annotation,
+                                                  within_class):
                             continue
                         self._defered_annotations[-1].append(
                             (arg.annotation, currentscopes, None))
 
-            if not self.future_annotations and node.returns:
-                if in_def695:
-                    try:
-                        _validate_annotation_body(node.returns)
-                        if in_def695 and parent_typename == 'ClassDef':
-                                _validate_annotation_body_within_class_scope(node.returns)
-                    except SyntaxError as e:
-                        self.warn(str(e), node.returns)
-                    else:
-                        self.visit(node.returns)
-                else:
-                    self.visit(node.returns)
-
             if in_def695:
                 # emulate this (except f is not actually defined in both scopes): 
                 # def695 __generic_parameters_of_f():
@@ -1066,32 +1311,47 @@ class DefUseChains(ast.NodeVisitor):
             else:
                 self.set_definition(node.name, dnode)
 
-            self._defered.append((node,
-                                  list(self._definitions),
-                                  list(self._scopes),
-                                  list(self._scope_depths),
-                                  list(self._precomputed_locals)))
+            self._defer(node)
         
         elif step is DefinitionStep:
-            with self.ScopeContext(node):
-                for arg in _iter_arguments(node.args):
-                    self.visit_skip_annotation(arg)
-                self.process_body(node.body)
+            self._enter_scope(node)
+            arguments = self._arguments_cache.pop(node.args, None)
+            if arguments is None:
+                arguments = _iter_arguments(node.args)
+            visit_skip_annotation = self.visit_skip_annotation
+            for arg in arguments:
+                visit_skip_annotation(arg)
+            self.process_body(node.body)
+            self._exit_scope()
         else:
             raise NotImplementedError()
 
     visit_AsyncFunctionDef = visit_FunctionDef
 
+    def _try_validate(self, anno, parent_is_class):
+        '''
+        Check that *anno* is a valid annotation body, warning and returning
+        False when it is not.
+        '''
+        try:
+            _validate_annotation_body(anno, within_class=parent_is_class)
+        except SyntaxError as e:
+            self._warn(str(e), anno)
+            return False
+        return True
+
     def visit_ClassDef(self, node, in_def695=False):
-        dnode = self.chains.setdefault(node, Def(node))
+        dnode = self._chain_of(node)
         self.add_to_locals(node.name, dnode)
         currentscopes = list(self._scopes)
+        # shared by all the class-level expressions defered in stubs
+        add_user = lambda duser: duser.add_user(dnode)
 
         if not in_def695:
             if self.is_stub:
                 for decorator in node.decorator_list:
                     self._defered_annotations[-1].append((
-                        decorator, currentscopes, lambda ddecorator: ddecorator.add_user(dnode)))
+                        decorator, currentscopes, add_user))
             else:
                 for decorator in node.decorator_list:
                     self.visit(decorator).add_user(dnode)
@@ -1100,59 +1360,40 @@ class DefUseChains(ast.NodeVisitor):
                 self.visit_def695(def695(body=node.type_params, d=node))
                 return
         
-        parent_typename = type(currentscopes[-1 if not in_def695 else -2]).__name__
+        parent_is_class = type(currentscopes[-1 if not in_def695 else -2]) in _ClassDef
 
         if self.is_stub:
             # special treatment for classes in stub modules
             # so they can contain forward-references.
             for base in node.bases:
-                if in_def695:
-                    try:
-                        _validate_annotation_body(base)
-                        if parent_typename == 'ClassDef':
-                            _validate_annotation_body_within_class_scope(base)
-                    except SyntaxError as e:
-                        self.warn(str(e), base)
-                        continue
+                if in_def695 and not self._try_validate(base,
+                                                        parent_is_class):
+                    continue
                 self._defered_annotations[-1].append((
-                    base, currentscopes, lambda dbase: dbase.add_user(dnode)))
+                    base, currentscopes, add_user))
             for keyword in node.keywords:
-                if in_def695:
-                    try:
-                        _validate_annotation_body(keyword)
-                        if parent_typename == 'ClassDef':
-                            _validate_annotation_body_within_class_scope(keyword)
-                    except SyntaxError as e:
-                        self.warn(str(e), keyword)
-                        continue
+                if in_def695 and not self._try_validate(keyword,
+                                                        parent_is_class):
+                    continue
                 self._defered_annotations[-1].append((
-                    keyword.value, currentscopes, lambda dkeyword: dkeyword.add_user(dnode)))
+                    keyword.value, currentscopes, add_user))
             
         else:
             for base in node.bases:
-                if in_def695:
-                    try:
-                        _validate_annotation_body(base)
-                        if parent_typename == 'ClassDef':
-                            _validate_annotation_body_within_class_scope(base)
-                    except SyntaxError as e:
-                        self.warn(str(e), base)
-                        continue
+                if in_def695 and not self._try_validate(base,
+                                                        parent_is_class):
+                    continue
                 self.visit(base).add_user(dnode)
             for keyword in node.keywords:
-                if in_def695:
-                    try:
-                        _validate_annotation_body(keyword)
-                        if parent_typename == 'ClassDef':
-                            _validate_annotation_body_within_class_scope(keyword)
-                    except SyntaxError as e:
-                        self.warn(str(e), keyword)
-                        continue
+                if in_def695 and not self._try_validate(keyword,
+                                                        parent_is_class):
+                    continue
                 self.visit(keyword.value).add_user(dnode)
 
-        with self.ScopeContext(node):
-            self.set_definition("__class__", Def("__class__"))
-            self.process_body(node.body)
+        self._enter_scope(node)
+        self.set_definition("__class__", Def("__class__"))
+        self.process_body(node.body)
+        self._exit_scope()
 
         if in_def695:
             # see comment in visit_FunctionDef
@@ -1164,14 +1405,24 @@ class DefUseChains(ast.NodeVisitor):
         if node.value:
             self.visit(node.value)
 
+    @staticmethod
+    def _merge_definitions(target, definitions):
+        for name, dnodes in definitions.items():
+            current = target.get(name)
+            if current is None:
+                # copy, as the sets of definitions may be shared with the
+                # enclosing blocks
+                target[name] = dnodes.copy()
+            else:
+                current.update(dnodes)
+
     def visit_Break(self, _):
-        for k, v in self._definitions[-1].items():
-            DefUseChains.add_to_definition(self._breaks[-1], k, v)
+        DefUseChains._merge_definitions(self._breaks[-1], self._definitions[-1])
         self._definitions[-1].clear()
 
     def visit_Continue(self, _):
-        for k, v in self._definitions[-1].items():
-            DefUseChains.add_to_definition(self._continues[-1], k, v)
+        DefUseChains._merge_definitions(self._continues[-1],
+                                        self._definitions[-1])
         self._definitions[-1].clear()
 
     def visit_Delete(self, node):
@@ -1201,7 +1452,7 @@ class DefUseChains(ast.NodeVisitor):
             try:
                 _validate_annotation_body(node.annotation)
             except SyntaxError as e:
-                self.warn(str(e), node.annotation)
+                self._warn(str(e), node.annotation)
             else:
                 self._defered_annotations[-1].append(
                     (node.annotation, list(self._scopes), None))
@@ -1209,12 +1460,12 @@ class DefUseChains(ast.NodeVisitor):
 
     def visit_AugAssign(self, node):
         dvalue = self.visit(node.value)
-        if type(node.target).__name__ == 'Name':
+        if type(node.target) in _Name:
             ctx, node.target.ctx = node.target.ctx, ast.Load()
             dtarget = self.visit(node.target)
             dvalue.add_user(dtarget)
             node.target.ctx = ctx
-            if any(node.target.id in _globals for _globals in self._globals):
+            if node.target.id in self._global_names:
                 self.extend_global(node.target.id, dtarget)
             else:
                 loaded_from = [d.name() for d in self.defs(node.target,
@@ -1223,7 +1474,7 @@ class DefUseChains(ast.NodeVisitor):
                 # If we augassign from a value that comes from '*', let's use
                 # this node as the definition point.
                 if '*' in loaded_from:
-                    self.locals[self._scopes[-1]].append(dtarget)
+                    self._add_local(self._scopes[-1], dtarget, unique=False)
         else:
             self.visit(node.target).add_user(dvalue)
     
@@ -1241,23 +1492,22 @@ class DefUseChains(ast.NodeVisitor):
         #     return __make_typealias(name='Alias', type_params=(T,), evaluate_value=__evaluate_Alias)
         # Alias = __generic_parameters_of_Alias()
 
-        if type(node.name).__name__ == 'Name':
-            dname = self.chains.setdefault(node.name, Def(node.name))
+        if type(node.name) in _Name:
+            dname = self._chain_of(node.name)
             self.add_to_locals(node.name.id, dname)
 
             if not in_def695 and any(getattr(node, 'type_params', [])):
                 self.visit_def695(def695(body=node.type_params, d=node))
                 return
             
-            parent_typename = type(self._scopes[-1 if not in_def695 else -2]).__name__
+            parent_is_class = type(self._scopes[-1 if not in_def695 else -2]) in _ClassDef
 
-            dnode = self.chains.setdefault(node, Def(node))
+            dnode = self._chain_of(node)
             try:
-                _validate_annotation_body(node.value)
-                if parent_typename == 'ClassDef':
-                    _validate_annotation_body_within_class_scope(node.value)
+                _validate_annotation_body(node.value,
+                                          within_class=parent_is_class)
             except SyntaxError as e:
-                self.warn(str(e), node.value)
+                self._warn(str(e), node.value)
             else:
                 self._defered_annotations[-1].append(
                     (node.value, list(self._scopes), None))
@@ -1275,30 +1525,38 @@ class DefUseChains(ast.NodeVisitor):
     def visit_For(self, node):
         self.visit(node.iter)
 
-        self._breaks.append(defaultdict(ordered_set))
-        self._continues.append(defaultdict(ordered_set))
+        self._breaks.append({})
+        self._continues.append({})
 
         self._undefs.append(defaultdict(list))
-        with self.DefinitionContext(self._definitions[-1].copy()) as body_defs:
-            self.visit(node.target)
-            self.process_body(node.body)
-            self.process_undefs()
+        body_defs = self._enter_definitions(self._definitions[-1].copy())
+        progress = self._loop_progress()
+        self.visit(node.target)
+        self.process_body(node.body)
+        repeated = progress != self._loop_progress()
+        undefs = self._undefs[-1]
+        self.process_undefs()
 
-            continue_defs = self._continues.pop()
-            for d, u in continue_defs.items():
-                self.extend_definition(d, u)
-            self._continues.append(defaultdict(ordered_set))
+        continue_defs = self._continues.pop()
+        for d, u in continue_defs.items():
+            self.extend_definition(d, u)
+        self._continues.append({})
 
-            # extra round to ``emulate'' looping
+        # extra round to ``emulate'' looping, unless it would resolve every
+        # name as the first one did and record nothing new
+        if (repeated or undefs or _binds_twice(node.target) or
+                _may_bind(node.body)):
             self.visit(node.target)
             self.process_body(node.body)
 
-            # process else clause in case of late break
-            with self.DefinitionContext(defaultdict(ordered_set)) as orelse_defs:
-                self.process_body(node.orelse)
+        # process else clause in case of late break
+        orelse_defs = self._enter_definitions(defaultdict(dict))
+        self.process_body(node.orelse)
+        self._exit_definitions()
 
-            break_defs = self._breaks.pop()
-            continue_defs = self._continues.pop()
+        break_defs = self._breaks.pop()
+        continue_defs = self._continues.pop()
+        self._exit_definitions()
 
 
         for d, u in orelse_defs.items():
@@ -1317,34 +1575,43 @@ class DefUseChains(ast.NodeVisitor):
 
     def visit_While(self, node):
 
-        with self.DefinitionContext(self._definitions[-1].copy()):
-            self._undefs.append(defaultdict(list))
-            self._breaks.append(defaultdict(ordered_set))
-            self._continues.append(defaultdict(ordered_set))
+        self._enter_definitions(self._definitions[-1].copy())
+        self._undefs.append(defaultdict(list))
+        self._breaks.append({})
+        self._continues.append({})
 
-            self.process_body(node.orelse)
+        self.process_body(node.orelse)
+        self._exit_definitions()
 
-        with self.DefinitionContext(self._definitions[-1].copy()) as body_defs:
+        body_defs = self._enter_definitions(self._definitions[-1].copy())
 
-            self.visit(node.test)
-            self.process_body(node.body)
+        progress = self._loop_progress()
+        self.visit(node.test)
+        self.process_body(node.body)
+        repeated = progress != self._loop_progress()
 
-            self.process_undefs()
+        undefs = self._undefs[-1]
+        self.process_undefs()
 
-            continue_defs = self._continues.pop()
-            for d, u in continue_defs.items():
-                self.extend_definition(d, u)
-            self._continues.append(defaultdict(ordered_set))
+        continue_defs = self._continues.pop()
+        for d, u in continue_defs.items():
+            self.extend_definition(d, u)
+        self._continues.append({})
 
-            # extra round to simulate loop
+        # extra round to simulate loop, unless it would resolve every name
+        # as the first one did and record nothing new
+        if (repeated or undefs or _may_bind(node.body) or
+                _may_bind((node.test,))):
             self.visit(node.test)
             self.process_body(node.body)
 
-            # the false branch of the eval
-            self.visit(node.test)
+        # the false branch of the eval
+        self.visit(node.test)
 
-            with self.DefinitionContext(self._definitions[-1].copy()) as orelse_defs:
-                self.process_body(node.orelse)
+        orelse_defs = self._enter_definitions(self._definitions[-1].copy())
+        self.process_body(node.orelse)
+        self._exit_definitions()
+        self._exit_definitions()
 
         break_defs = self._breaks.pop()
         continue_defs = self._continues.pop()
@@ -1365,15 +1632,24 @@ class DefUseChains(ast.NodeVisitor):
         self.visit(node.test)
 
         # putting a copy of current level to handle nested conditions
-        with self.DefinitionContext(self._definitions[-1].copy()) as body_defs:
-            self.process_body(node.body)
+        body_defs = self._enter_definitions(self._definitions[-1].copy())
+        self.process_body(node.body)
+        self._exit_definitions()
 
-        with self.DefinitionContext(self._definitions[-1].copy()) as orelse_defs:
+        if node.orelse:
+            orelse_defs = self._enter_definitions(
+                self._definitions[-1].copy())
             self.process_body(node.orelse)
+            self._exit_definitions()
+        else:
+            # an empty branch leaves the definitions untouched, no need to
+            # copy them. Each name is read before it is updated below.
+            orelse_defs = self._definitions[-1]
 
+        current = self._definitions[-1]
         for d in body_defs:
             if d in orelse_defs:
-                self.set_definition(d, body_defs[d] + orelse_defs[d])
+                self._merge_branches(current, d, body_defs[d], orelse_defs[d])
             else:
                 self.extend_definition(d, body_defs[d])
 
@@ -1383,6 +1659,20 @@ class DefUseChains(ast.NodeVisitor):
             else:
                 self.extend_definition(d, orelse_defs[d])
 
+    def _merge_branches(self, current, name, body, orelse):
+        """
+        Set the definitions of *name* bound in both branches of a condition.
+        """
+        if body is orelse and body is current.get(name):
+            # neither branch rebound the name, so nothing is killed. Still
+            # copy the definitions as they may be shared with outer blocks.
+            if not self._deadcode:
+                current[name] = body.copy()
+        elif body is orelse:
+            self.set_definition(name, body)
+        else:
+            self.set_definition(name, {**body, **orelse})
+
     def visit_With(self, node):
         for withitem in node.items:
             self.visit(withitem)
@@ -1394,17 +1684,19 @@ class DefUseChains(ast.NodeVisitor):
         self.generic_visit(node)
 
     def visit_Try(self, node):
-        with self.DefinitionContext(self._definitions[-1].copy()) as failsafe_defs:
-            self.process_body(node.body)
-            self.process_body(node.orelse)
+        failsafe_defs = self._enter_definitions(self._definitions[-1].copy())
+        self.process_body(node.body)
+        self.process_body(node.orelse)
+        self._exit_definitions()
 
         # handle the fact that definitions may have fail
         for d in failsafe_defs:
             self.extend_definition(d, failsafe_defs[d])
 
         for excepthandler in node.handlers:
-            with self.DefinitionContext(defaultdict(ordered_set)) as handler_def:
-                self.visit(excepthandler)
+            handler_def = self._enter_definitions(defaultdict(dict))
+            self.visit(excepthandler)
+            self._exit_definitions()
 
             for hd in handler_def:
                 self.extend_definition(hd, handler_def[hd])
@@ -1419,44 +1711,65 @@ class DefUseChains(ast.NodeVisitor):
             self.visit(node.msg)
 
     def add_to_locals(self, name, dnode, index=-1):
-        if any(name in _globals for _globals in self._globals):
+        if name in self._global_names:
             self.set_or_extend_global(name, dnode)
-        elif dnode not in self.locals[self._scopes[index]]:
-            self.locals[self._scopes[index]].append(dnode)
+        else:
+            self._add_local(self._scopes[index], dnode)
+
+    def _add_local(self, scope, dnode, unique=True):
+        """
+        Appends *dnode* to the locals of *scope*, unless *unique* is true and
+        it is already there.
+        """
+        known = self._locals_index[scope]
+        if unique and dnode in known:
+            return
+        known.add(dnode)
+        self.locals[scope].append(dnode)
+        self._locals_names[scope].setdefault(dnode.name(), []).append(dnode)
 
     def visit_Import(self, node):
+        imports = self.imports
         for alias in node.names:
-            dalias = self.chains.setdefault(alias, Def(alias))
-            base = alias.name.split(".", 1)[0]
+            dalias = self._chain_of(alias)
+            base = _import_base(alias.name)
             self.set_definition(alias.asname or base, dalias)
             self.add_to_locals(alias.asname or base, dalias)
-        self.imports.update(parse_import(node, self.modname, is_package=self.is_package))
+            # same as parse_import, see the note there about submodules
+            imports[alias] = ImportInfo(
+                orgmodule=alias.name if alias.asname else base)
 
     def visit_ImportFrom(self, node):
+        imports = self.imports
+        orgmodule = _import_from_module(node, self.modname, self.is_package)
         for alias in node.names:
-            dalias = self.chains.setdefault(alias, Def(alias))
+            dalias = self._chain_of(alias)
             if alias.name == '*':
                 self.extend_definition('*', dalias)
             else:
                 self.set_definition(alias.asname or alias.name, dalias)
             self.add_to_locals(alias.asname or alias.name, dalias)
-        self.imports.update(parse_import(node, self.modname, is_package=self.is_package))
+            imports[alias] = ImportInfo(orgmodule=orgmodule, orgname=alias.name)
 
     def visit_Global(self, node):
+        global_names = self._global_names
         for name in node.names:
-            self._globals[-1].add(name)
+            if name not in self._globals[-1]:
+                self._globals[-1].add(name)
+                global_names[name] = global_names.get(name, 0) + 1
 
     def visit_Nonlocal(self, node):
+        definitions = self._definitions
         for name in node.names:
-            for i, d in enumerate(reversed(self._definitions)):
-                if i == 0:
-                    continue
+            # walk the enclosing blocks, innermost first
+            for i in range(1, len(definitions)):
+                d = definitions[-i-1]
                 if name not in d:
                     continue
                 else:
                     if isinstance(self._scopes[-i-1], def695):
                         # see https://docs.python.org/3.12/reference/executionmodel.html#annotation-scopes
-                        self.warn("names defined in annotation scopes cannot be rebound with nonlocal statements", node)
+                        self._warn("names defined in annotation scopes cannot be rebound with nonlocal statements", node)
                         break
                     # this rightfully creates aliasing
                     self.set_definition(name, d[name])
@@ -1479,8 +1792,9 @@ class DefUseChains(ast.NodeVisitor):
                 self.visit(kase.guard)
             self.visit(kase.pattern)
             
-            with self.DefinitionContext(self._definitions[-1].copy()) as case_defs:
-                self.process_body(kase.body)
+            case_defs = self._enter_definitions(self._definitions[-1].copy())
+            self.process_body(kase.body)
+            self._exit_definitions()
             defs.append(case_defs)
         
         if not defs:
@@ -1489,11 +1803,13 @@ class DefUseChains(ast.NodeVisitor):
             body_defs, orelse_defs, rest = defs[0], [], []
         else:
             body_defs, orelse_defs, rest = defs[0], defs[1], defs[2:]
+        current = self._definitions[-1]
         while True:
             # merge defs, like in if-else but repeat the process for x branches       
             for d in body_defs:
                 if d in orelse_defs:
-                    self.set_definition(d, body_defs[d] + orelse_defs[d])
+                    self._merge_branches(current, d, body_defs[d],
+                                         orelse_defs[d])
                 else:
                     self.extend_definition(d, body_defs[d])
             for d in orelse_defs:
@@ -1505,7 +1821,7 @@ class DefUseChains(ast.NodeVisitor):
             orelse_defs, rest = rest[0], rest[1:]
     
     def visit_MatchValue(self, node):
-        dnode = self.chains.setdefault(node, Def(node))
+        dnode = self._chain_of(node)
         self.visit(node.value)
         return dnode
 
@@ -1513,22 +1829,27 @@ class DefUseChains(ast.NodeVisitor):
     
     def visit_MatchSequence(self, node):
         # mimics a list
-        with _setattrs(node, ctx=ast.Load(), elts=node.patterns):
+        node.ctx, node.elts = ast.Load(), node.patterns
+        try:
             return self.visit_List(node)
+        finally:
+            del node.ctx, node.elts
     
     def visit_MatchMapping(self, node):
-        dnode = self.chains.setdefault(node, Def(node))
-        with _setattrs(node, values=node.patterns):
-            # mimics a dict
+        dnode = self._chain_of(node)
+        # mimics a dict
+        node.values = node.patterns
+        try:
             self.visit_Dict(node)
+        finally:
+            del node.values
         if node.rest:
-            with _setattrs(node, id=node.rest, ctx=ast.Store(), annotation=None):
-                self.visit_Name(node)
+            self._visit_capture(node, node.rest)
         return dnode
     
     def visit_MatchClass(self, node):
         # mimics a call
-        dnode = self.chains.setdefault(node, Def(node))
+        dnode = self._chain_of(node)
         self.visit(node.cls).add_user(dnode)
         for arg in node.patterns:
             self.visit(arg).add_user(dnode)
@@ -1537,24 +1858,29 @@ class DefUseChains(ast.NodeVisitor):
         return dnode
     
     def visit_MatchStar(self, node):
-        dnode = self.chains.setdefault(node, Def(node))
+        dnode = self._chain_of(node)
         if node.name:
-            # mimics store name
-            with _setattrs(node, id=node.name, ctx=ast.Store(), annotation=None):
-                self.visit_Name(node)
+            self._visit_capture(node, node.name)
         return dnode
     
     def visit_MatchAs(self, node):
-        dnode = self.chains.setdefault(node, Def(node))
+        dnode = self._chain_of(node)
         if node.pattern:
             self.visit(node.pattern)
         if node.name:
-            with _setattrs(node, id=node.name, ctx=ast.Store(), annotation=None):
-                self.visit_Name(node)
+            self._visit_capture(node, node.name)
         return dnode
+
+    def _visit_capture(self, node, name):
+        # mimics store name
+        node.id, node.ctx, node.annotation = name, ast.Store(), None
+        try:
+            self.visit_Name(node)
+        finally:
+            del node.id, node.ctx, node.annotation
     
     def visit_MatchOr(self, node):
-        dnode = self.chains.setdefault(node, Def(node))
+        dnode = self._chain_of(node)
         for pat in node.patterns:
             self.visit(pat).add_user(dnode)
         return dnode
@@ -1562,107 +1888,114 @@ class DefUseChains(ast.NodeVisitor):
     # expressions
 
     def visit_BoolOp(self, node):
-        dnode = self.chains.setdefault(node, Def(node))
+        dnode = self._chain_of(node)
+        visit = self.visit
         for value in node.values:
-            self.visit(value).add_user(dnode)
+            visit(value).add_user(dnode)
         return dnode
 
     def visit_BinOp(self, node):
-        dnode = self.chains.setdefault(node, Def(node))
-        self.visit(node.left).add_user(dnode)
-        self.visit(node.right).add_user(dnode)
+        dnode = self._chain_of(node)
+        visit = self.visit
+        visit(node.left).add_user(dnode)
+        visit(node.right).add_user(dnode)
         return dnode
 
     def visit_UnaryOp(self, node):
-        dnode = self.chains.setdefault(node, Def(node))
+        dnode = self._chain_of(node)
         self.visit(node.operand).add_user(dnode)
         return dnode
 
     def visit_Lambda(self, node, step=DeclarationStep):
         if step is DeclarationStep:
-            dnode = self.chains.setdefault(node, Def(node))
+            dnode = self._chain_of(node)
             for default in node.args.defaults:
                 self.visit(default).add_user(dnode)
             # a lambda never has kw_defaults
-            self._defered.append((node,
-                                  list(self._definitions),
-                                  list(self._scopes),
-                                  list(self._scope_depths),
-                                  list(self._precomputed_locals)))
+            self._defer(node)
             return dnode
         elif step is DefinitionStep:
             dnode = self.chains[node]
-            with self.ScopeContext(node):
-                for a in _iter_arguments(node.args):
-                    self.visit(a)
-                self.visit(node.body).add_user(dnode)
+            self._enter_scope(node)
+            for a in _iter_arguments(node.args):
+                self.visit(a)
+            self.visit(node.body).add_user(dnode)
+            self._exit_scope()
             return dnode
         else:
             raise NotImplementedError()
 
     def visit_IfExp(self, node):
-        dnode = self.chains.setdefault(node, Def(node))
-        self.visit(node.test).add_user(dnode)
-        self.visit(node.body).add_user(dnode)
-        self.visit(node.orelse).add_user(dnode)
+        dnode = self._chain_of(node)
+        visit = self.visit
+        visit(node.test).add_user(dnode)
+        visit(node.body).add_user(dnode)
+        visit(node.orelse).add_user(dnode)
         return dnode
 
     def visit_Dict(self, node):
-        dnode = self.chains.setdefault(node, Def(node))
-        for key in filter(None, node.keys):
-            self.visit(key).add_user(dnode)
-        for value in node.values:
-            self.visit(value).add_user(dnode)
+        dnode = self._chain_of(node)
+        visit = self.visit
+        for key, value in zip(node.keys, node.values):
+            # a None key stands for a ``**`` unpacking
+            if key is not None:
+                visit(key).add_user(dnode)
+            visit(value).add_user(dnode)
         return dnode
 
     def visit_Set(self, node):
-        dnode = self.chains.setdefault(node, Def(node))
+        dnode = self._chain_of(node)
+        visit = self.visit
         for elt in node.elts:
-            self.visit(elt).add_user(dnode)
+            visit(elt).add_user(dnode)
         return dnode
 
     def visit_ListComp(self, node):
-        dnode = self.chains.setdefault(node, Def(node))
-        try:
-            _validate_comprehension(node)
-        except SyntaxError as e:
-            self.warn(str(e), node)
-            return dnode
-        with self.CompScopeContext(node):
-            for i, comprehension in enumerate(node.generators):
-                self.visit_comprehension(comprehension, 
-                                         is_nested=i!=0).add_user(dnode)
-            self.visit(node.elt).add_user(dnode)
+        dnode = self._chain_of(node)
+        if _contains(node, _NamedExpr):
+            try:
+                _validate_comprehension(node)
+            except SyntaxError as e:
+                self._warn(str(e), node)
+                return dnode
+        self._enter_scope(node)
+        for i, comprehension in enumerate(node.generators):
+            self.visit_comprehension(comprehension, 
+                                     is_nested=i!=0).add_user(dnode)
+        self.visit(node.elt).add_user(dnode)
+        self._exit_scope()
 
         return dnode
 
     visit_SetComp = visit_ListComp
 
     def visit_DictComp(self, node):
-        dnode = self.chains.setdefault(node, Def(node))
-        try:
-            _validate_comprehension(node)
-        except SyntaxError as e:
-            self.warn(str(e), node)
-            return dnode
-        with self.CompScopeContext(node):
-            for i, comprehension in enumerate(node.generators):
-                self.visit_comprehension(comprehension, 
-                                         is_nested=i!=0).add_user(dnode)
-            self.visit(node.key).add_user(dnode)
-            self.visit(node.value).add_user(dnode)
+        dnode = self._chain_of(node)
+        if _contains(node, _NamedExpr):
+            try:
+                _validate_comprehension(node)
+            except SyntaxError as e:
+                self._warn(str(e), node)
+                return dnode
+        self._enter_scope(node)
+        for i, comprehension in enumerate(node.generators):
+            self.visit_comprehension(comprehension, 
+                                     is_nested=i!=0).add_user(dnode)
+        self.visit(node.key).add_user(dnode)
+        self.visit(node.value).add_user(dnode)
+        self._exit_scope()
 
         return dnode
 
     visit_GeneratorExp = visit_ListComp
 
     def visit_Await(self, node):
-        dnode = self.chains.setdefault(node, Def(node))
+        dnode = self._chain_of(node)
         self.visit(node.value).add_user(dnode)
         return dnode
 
     def visit_Yield(self, node):
-        dnode = self.chains.setdefault(node, Def(node))
+        dnode = self._chain_of(node)
         if node.value:
             self.visit(node.value).add_user(dnode)
         return dnode
@@ -1670,14 +2003,15 @@ class DefUseChains(ast.NodeVisitor):
     visit_YieldFrom = visit_Await
 
     def visit_Compare(self, node):
-        dnode = self.chains.setdefault(node, Def(node))
-        self.visit(node.left).add_user(dnode)
+        dnode = self._chain_of(node)
+        visit = self.visit
+        visit(node.left).add_user(dnode)
         for expr in node.comparators:
-            self.visit(expr).add_user(dnode)
+            visit(expr).add_user(dnode)
         return dnode
 
     def visit_Call(self, node):
-        dnode = self.chains.setdefault(node, Def(node))
+        dnode = self._chain_of(node)
         self.visit(node.func).add_user(dnode)
         if self.is_stub and matches_typing_name(
                 self._scopes, self.locals, self.imports, self._modnames, 
@@ -1685,14 +2019,13 @@ class DefUseChains(ast.NodeVisitor):
             # In stubs, constraints and bound argument 
             # of TypeVar() can be forward references.
             current_scopes = list(self._scopes)
+            add_user = lambda darg: darg.add_user(dnode)
             for arg in node.args:
                 self._defered_annotations[-1].append(
-                    (arg, current_scopes,
-                    lambda darg:darg.add_user(dnode)))
+                    (arg, current_scopes, add_user))
             for kw in node.keywords:
                 self._defered_annotations[-1].append(
-                    (kw.value, current_scopes,
-                    lambda dkw:dkw.add_user(dnode)))
+                    (kw.value, current_scopes, add_user))
         else:
             for arg in node.args:
                 self.visit(arg).add_user(dnode)
@@ -1703,18 +2036,18 @@ class DefUseChains(ast.NodeVisitor):
     visit_Repr = visit_Await
 
     def visit_Constant(self, node):
-        dnode = self.chains.setdefault(node, Def(node))
+        dnode = self._chain_of(node)
         return dnode
 
     def visit_FormattedValue(self, node):
-        dnode = self.chains.setdefault(node, Def(node))
+        dnode = self._chain_of(node)
         self.visit(node.value).add_user(dnode)
         if node.format_spec:
             self.visit(node.format_spec).add_user(dnode)
         return dnode
 
     def visit_JoinedStr(self, node):
-        dnode = self.chains.setdefault(node, Def(node))
+        dnode = self._chain_of(node)
         for value in node.values:
             self.visit(value).add_user(dnode)
         return dnode
@@ -1722,40 +2055,40 @@ class DefUseChains(ast.NodeVisitor):
     visit_Attribute = visit_Await
 
     def visit_Subscript(self, node):
-        dnode = self.chains.setdefault(node, Def(node))
+        dnode = self._chain_of(node)
         self.visit(node.value).add_user(dnode)
         self.visit(node.slice).add_user(dnode)
         return dnode
 
     def visit_Starred(self, node):
-        if type(node.ctx).__name__ == 'Store':
+        if type(node.ctx) in _Store:
             return self.visit(node.value)
         else:
-            dnode = self.chains.setdefault(node, Def(node))
+            dnode = self._chain_of(node)
             self.visit(node.value).add_user(dnode)
             return dnode
 
     def visit_NamedExpr(self, node):
-        dnode = self.chains.setdefault(node, Def(node))
+        dnode = self._chain_of(node)
         self.visit(node.value).add_user(dnode)
-        if type(node.target).__name__ == 'Name':
+        if type(node.target) in _Name:
             self.visit_Name(node.target, named_expr=True)
         return dnode
 
     def _first_non_comprehension_scope(self):
         index = -1
         enclosing_scope = self._scopes[index]
-        while type(enclosing_scope).__name__ in _Comp:
+        while type(enclosing_scope) in _Comp:
             index -= 1
             enclosing_scope = self._scopes[index]
         return index, enclosing_scope
 
     def visit_Name(self, node, skip_annotation=False, named_expr=False):
-        ctx_typename = type(node.ctx).__name__
-        if ctx_typename in ('Param', 'Store'):
-            dnode = self.chains.setdefault(node, Def(node))
+        ctxtype = type(node.ctx)
+        if ctxtype in _StoreOrParam:
+            dnode = self._chain_of(node)
             # FIXME: find a smart way to merge the code below with add_to_locals
-            if any(node.id in _globals for _globals in self._globals):
+            if node.id in self._global_names:
                 self.set_or_extend_global(node.id, dnode)
             else:
                 # special code for warlus target: should be 
@@ -1763,29 +2096,27 @@ class DefUseChains(ast.NodeVisitor):
                 index, enclosing_scope = (self._first_non_comprehension_scope() 
                                           if named_expr else (-1, self._scopes[-1]))
 
-                if index < -1 and type(enclosing_scope).__name__ == 'ClassDef':
+                if index < -1 and type(enclosing_scope) in _ClassDef:
                     # invalid named expression, not calling set_definition.
-                    self.warn('assignment expression within a comprehension '
-                              'cannot be used in a class body', node)
+                    self._warn('assignment expression within a comprehension '
+                               'cannot be used in a class body', node)
                     return dnode
 
                 self.set_definition(node.id, dnode, index)
-                if dnode not in self.locals[self._scopes[index]]:
-                    self.locals[self._scopes[index]].append(dnode)
+                self._add_local(self._scopes[index], dnode)
 
             # Name.annotation is a special case because of gast
             if getattr(node, 'annotation', None) is not None and not skip_annotation and not self.future_annotations:
                 self.visit(node.annotation)
 
-        elif ctx_typename in ('Load', 'Del'):
-            node_in_chains = node in self.chains
-            if node_in_chains:
-                dnode = self.chains[node]
-            else:
+        elif ctxtype in _LoadOrDel:
+            dnode = self.chains.get(node)
+            is_new = dnode is None
+            if is_new:
                 dnode = Def(node)
             for d in self.defs(node):
                 d.add_user(dnode)
-            if not node_in_chains:
+            if is_new:
                 self.chains[node] = dnode
             # currently ignore the effect of a del
         else:
@@ -1793,29 +2124,29 @@ class DefUseChains(ast.NodeVisitor):
         return dnode
 
     def visit_Destructured(self, node):
-        dnode = self.chains.setdefault(node, Def(node))
-        tmp_store = ast.Store()
+        dnode = self._chain_of(node)
         for elt in node.elts:
-            elt_typename = type(elt).__name__
-            if elt_typename == 'Name':
-                tmp_store, elt.ctx = elt.ctx, tmp_store
+            elttype = type(elt)
+            if elttype in _Name:
+                ctx, elt.ctx = elt.ctx, _TMP_STORE
                 self.visit(elt)
-                tmp_store, elt.ctx = elt.ctx, tmp_store
-            elif elt_typename in ('Subscript', 'Starred', 'Attribute'):
+                elt.ctx = ctx
+            elif elttype in _SubscriptStarredOrAttribute:
                 self.visit(elt)
-            elif elt_typename in ('List', 'Tuple'):
+            elif elttype in _ListOrTuple:
                 self.visit_Destructured(elt)
         return dnode
 
     def visit_List(self, node):
-        if type(node.ctx).__name__ == 'Load':
-            dnode = self.chains.setdefault(node, Def(node))
+        ctxtype = type(node.ctx)
+        if ctxtype in _Load:
+            dnode = self._chain_of(node)
             for elt in node.elts:
                 self.visit(elt).add_user(dnode)
             return dnode
         # unfortunately, destructured node are marked as Load,
         # only the parent List/Tuple is marked as Store
-        elif type(node.ctx).__name__ == 'Store':
+        elif ctxtype in _Store:
             return self.visit_Destructured(node)
         else:
             raise NotImplementedError()
@@ -1825,7 +2156,7 @@ class DefUseChains(ast.NodeVisitor):
     # slice
 
     def visit_Slice(self, node):
-        dnode = self.chains.setdefault(node, Def(node))
+        dnode = self._chain_of(node)
         if node.lower:
             self.visit(node.lower).add_user(dnode)
         if node.upper:
@@ -1848,29 +2179,30 @@ class DefUseChains(ast.NodeVisitor):
         # 6.the constraints of type variables
         
         # introduce the new scope
-        dnode = self.chains.setdefault(node.d, Def(node.d))
+        dnode = self._chain_of(node.d)
         
-        with self.ScopeContext(node):
-            # visit the type params
-            for p in node.body:
-                try:
-                    _validate_annotation_body(p)
-                except SyntaxError as e:
-                    self.warn(str(e), p)
-                else:
-                    self.visit(p).add_user(dnode)
-            # then visit the actual node while 
-            # being in the def695 scope.
-            visitor = getattr(self, "visit_{}".format(type(node.d).__name__))
-            visitor(node.d, in_def695=True)
+        self._enter_scope(node)
+        # visit the type params
+        for p in node.body:
+            try:
+                _validate_annotation_body(p)
+            except SyntaxError as e:
+                self._warn(str(e), p)
+            else:
+                self.visit(p).add_user(dnode)
+        # then visit the actual node while 
+        # being in the def695 scope.
+        visitor = self._get_visitor(type(node.d))
+        visitor(self, node.d, in_def695=True)
+        self._exit_scope()
 
     def visit_TypeVar(self, node):
         # these nodes can only be visited under a def695 scope
-        dnode = self.chains.setdefault(node, Def(node))
+        dnode = self._chain_of(node)
         self.set_definition(node.name, dnode)
         self.add_to_locals(node.name, dnode)
 
-        if type(node).__name__ == 'TypeVar' and node.bound:
+        if type(node) in _TypeVar and node.bound:
             self._defered_annotations[-1].append(
                 (node.bound, list(self._scopes), None))
         
@@ -1881,13 +2213,20 @@ class DefUseChains(ast.NodeVisitor):
     # misc
 
     def visit_comprehension(self, node, is_nested):
-        dnode = self.chains.setdefault(node, Def(node))
+        dnode = self._chain_of(node)
         if not is_nested:
             # There's one part of a comprehension or generator expression that executes in the surrounding scope, 
             # it's the expression for the outermost iterable.
-            with self.SwitchScopeContext(self._definitions[:-1], self._scopes[:-1], 
-                                        self._scope_depths[:-1], self._precomputed_locals[:-1]):
+            # Temporarily pop the comprehension scope rather than switching
+            # to sliced copies of the scope stacks.
+            stacks = (self._definitions, self._scopes, self._scope_depths,
+                      self._precomputed_locals)
+            tops = [stack.pop() for stack in stacks]
+            try:
                 self.visit(node.iter).add_user(dnode)
+            finally:
+                for stack, top in zip(stacks, tops):
+                    stack.append(top)
         else:
             # If a comprehension has multiple for clauses, 
             # the iterables of the inner for clauses are evaluated in the comprehension's scope:
@@ -1898,7 +2237,7 @@ class DefUseChains(ast.NodeVisitor):
         return dnode
 
     def visit_excepthandler(self, node):
-        dnode = self.chains.setdefault(node, Def(node))
+        dnode = self._chain_of(node)
         if node.type:
             self.visit(node.type).add_user(dnode)
         if node.name:
@@ -1909,26 +2248,91 @@ class DefUseChains(ast.NodeVisitor):
     # visit_arguments is not implemented on purpose
 
     def visit_withitem(self, node):
-        dnode = self.chains.setdefault(node, Def(node))
+        dnode = self._chain_of(node)
         self.visit(node.context_expr).add_user(dnode)
         if node.optional_vars:
             self.visit(node.optional_vars)
         return dnode
 
+def _walk(node):
+    """
+    Same as ``ast.walk``, yielding nodes in the same breadth first order, but
+    only looking at the fields that may hold nodes.
+    """
+    todo = [node]
+    push, extend = todo.append, todo.extend
+    for n in todo:
+        yield n
+        for field in _child_fields(n):
+            value = getattr(n, field, None)
+            if type(value) is list:
+                extend(item for item in value if isinstance(item, _ast.AST))
+            elif isinstance(value, _ast.AST):
+                push(value)
+
+def _contains(node, types):
+    """
+    Whether *node* or any of its descendants has one of the given types.
+    """
+    todo = [node]
+    pop, push, extend = todo.pop, todo.append, todo.extend
+    while todo:
+        n = pop()
+        if not isinstance(n, _ast.AST):
+            # lists of children may hold None (Dict.keys) or identifiers
+            continue
+        if type(n) in types:
+            return True
+        for field in _child_fields(n):
+            value = getattr(n, field, None)
+            if type(value) is list:
+                extend(value)
+            elif isinstance(value, _ast.AST):
+                push(value)
+    return False
+
+# markers of the comprehension parts checked by _validate_comprehension
+_ITER, _TARGET = object(), object()
+
 def _validate_comprehension(node):
     """
     Raises SyntaxError if:
      - a named expression is used in a comprehension iterable expression
      - a named expression rebinds a comprehension iteration variable
+
+    The comprehension is walked once, breadth first like ``ast.walk``,
+    tracking whether each node belongs to an iterable expression or to
+    an iteration target of the comprehension.
     """
-    iter_names = set() # comprehension iteration variables
+    # roots of the iterable expressions and iteration targets
+    regions = {}
     for gen in node.generators:
-        for namedexpr in (n for n in ast.walk(gen.iter) if type(n).__name__ == 'NamedExpr'):
-            raise SyntaxError('assignment expression cannot be used '
-                                'in a comprehension iterable expression')
-        iter_names.update(n.id for n in ast.walk(gen.target) 
-            if type(n).__name__ == 'Name' and type(n.ctx).__name__ == 'Store')
-    for namedexpr in (n for n in ast.walk(node) if  type(n).__name__ == 'NamedExpr'):
+        regions[gen.iter] = _ITER
+        regions[gen.target] = _TARGET
+
+    iter_names = set() # comprehension iteration variables
+    namedexprs = []
+    todo = [(node, None)]
+    for n, region in todo:
+        region = regions.get(n, region)
+        ntype = type(n)
+        if ntype in _NamedExpr:
+            if region is _ITER:
+                raise SyntaxError('assignment expression cannot be used '
+                                  'in a comprehension iterable expression')
+            namedexprs.append(n)
+        elif (region is _TARGET and ntype in _Name and
+                type(n.ctx) in _Store):
+            iter_names.add(n.id)
+        for field in _child_fields(n):
+            value = getattr(n, field, None)
+            if type(value) is list:
+                todo.extend((item, region) for item in value
+                            if isinstance(item, _ast.AST))
+            elif isinstance(value, _ast.AST):
+                todo.append((value, region))
+
+    for namedexpr in namedexprs:
         bound = getattr(namedexpr.target, 'id', None)
         if bound in iter_names:
             raise SyntaxError('assignment expression cannot rebind '
@@ -1946,25 +2350,28 @@ _node_type_to_human_name = {
     'Lambda': 'lambda expression'
 }
 
-def _validate_annotation_body(node):
+def _validate_annotation_body(node, within_class=False):
     """
     Raises SyntaxError if:
     - the warlus operator is used
     - the yield/ yield from statement is used
     - the await keyword is used
-    """
-    for illegal in (n for n in ast.walk(node) if type(n).__name__ in  
-                    ('NamedExpr', 'Yield', 'YieldFrom', 'Await')):
-        name = _node_type_to_human_name.get(type(illegal).__name__, 'current syntax')
-        raise SyntaxError(f'{name} cannot be used in annotation-like scopes')
+    - a nested scope is used, if *within_class* is true
 
-def _validate_annotation_body_within_class_scope(node):
-    """
-    Raises SyntaxError if a nested scope is used.
+    The annotation is walked once for both rules, yet a nested scope is
+    only reported if no other error is found.
     """
-    for illegal in (n for n in ast.walk(node) if type(n).__name__ in  
-                    ('ListComp', 'GeneratorExp', 'SetComp', 'DictComp', 'Lambda')):
-        name = _node_type_to_human_name.get(type(illegal).__name__, 'current syntax')
+    nested_scope = None
+    for n in _walk(node):
+        ntype = type(n)
+        if ntype in _AnnotationIllegal:
+            name = _node_type_to_human_name.get(ntype.__name__, 'current syntax')
+            raise SyntaxError(f'{name} cannot be used in annotation-like scopes')
+        if within_class and nested_scope is None and ntype in _NestedScopes:
+            nested_scope = ntype
+    if nested_scope is not None:
+        name = _node_type_to_human_name.get(nested_scope.__name__,
+                                            'current syntax')
         raise SyntaxError(f'{name} cannot be used in annotation scope within class scope')
 
 def _iter_arguments(args):
@@ -1982,6 +2389,36 @@ def _iter_arguments(args):
     if args.kwarg:
         yield args.kwarg
 
+def _may_bind(nodes):
+    """
+    Whether any of the given nodes may bind a name, or break out of the
+    enclosing loop. When they do not, a second pass over a loop body would
+    see the same definitions as the first one.
+    """
+    for root in nodes:
+        for node in _walk(root):
+            nodetype = type(node)
+            if nodetype in _Binders:
+                return True
+            if nodetype in _Name and type(node.ctx) not in _Load:
+                return True
+    return False
+
+def _binds_twice(target):
+    """
+    Whether the given loop target binds a name more than once, as in
+    ``for _, _ in items``: visiting it again kills the other definition.
+    """
+    if type(target) in _Name:
+        return False
+    names = set()
+    for node in _walk(target):
+        if type(node) in _Name and type(node.ctx) not in _Load:
+            if node.id in names:
+                return True
+            names.add(node.id)
+    return False
+
 def lookup_annotation_name_defs(name, heads, locals_map):
     r"""
     Simple identifier -> defs resolving.
@@ -2023,65 +2460,78 @@ def lookup_annotation_name_defs(name, heads, locals_map):
     >>> print(lookup_annotation_name_defs('C', heads, duc.locals)[0])
     C -> ()
     """
+    scopes = _get_annotation_lookup_scopes(heads)
+    defs = _lookup(name, scopes, locals_map)
+    if defs:
+        return defs
+    if name in BuiltinsSrc:
+        raise LookupError(f'{name} is a builtin')
+    if not _lookup(name, scopes, locals_map, only_live=False):
+        defined_names = [d.name() for s in scopes for d in locals_map[s]]
+        raise LookupError("'{}' not found in scopes: {} (heads={}) (available names={})".format(name, scopes, heads, defined_names))
+    else:
+        raise LookupError("'{}' is killed".format(name))
+
+def _get_annotation_lookup_scopes(heads):
+    # returns the scopes in which an annotation name is looked up,
+    # the last one being looked up first.
     scopes = _get_lookup_scopes(heads)
-    scopes_len = len(scopes)
-    if scopes_len > 1 and not isinstance(scopes[-1], def695):
+    if len(scopes) > 1 and not isinstance(scopes[-1], def695):
         # start by looking at module scope first,
         # then try the theoretical runtime scopes.
         # putting the global scope last in the list so annotation are
         # resolve using he global namespace first. this is the way pyright does.
         # EXCEPT is we're direcly inside a pep695 scope, in this case follow usual rules.
         scopes.append(scopes.pop(0))
-    try:
-        return _lookup(name, scopes, locals_map)
-    except LookupError:
-        if name in BuiltinsSrc:
-            raise LookupError(f'{name} is a builtin')
-        try:
-            _lookup(name, scopes, locals_map, only_live=False)
-        except LookupError:
-            defined_names = [d.name() for s in scopes for d in locals_map[s]]
-            raise LookupError("'{}' not found in scopes: {} (heads={}) (available names={})".format(name, scopes, heads, defined_names))
-        else:
-            raise LookupError("'{}' is killed".format(name))
+    return scopes
 
 def _get_lookup_scopes(heads):
     # heads[-1] is the direct enclosing scope and heads[0] is the module.
     # returns a list based on the elements of heads, but with
     # the ignorable scopes removed. Ignorable in the sens that the lookup
     # will never happend in this scope for the given context.
-
-    heads = list(heads) # avoid modifying the list (important)
-    try:
-        direct_scopes = [heads.pop(-1)] # this scope is the only one that can be a class, expect in case of the presence of def695
-    except IndexError:
+    # heads is not modified (important).
+    if not isinstance(heads, (list, tuple)):
+        heads = list(heads)
+    if not heads:
         raise ValueError('invalid heads: must include at least one element')
-    try:
-        global_scope = heads.pop(0)
-    except IndexError:
+    # this scope is the only one that can be a class, expect in case of the presence of def695
+    direct_scopes = [heads[-1]]
+    end = len(heads) - 1
+    if not end:
         # we got only a global scope
         return direct_scopes
-    else:
-        if (heads and isinstance(direct_scopes[-1], def695) and 
-            type(heads[-1]).__name__ == 'ClassDef'):
-            # include the enclosing class scope in case we're in a def695 scope
-            direct_scopes.insert(0, heads.pop(-1))
+    if (end > 1 and isinstance(direct_scopes[-1], def695) and
+            type(heads[end - 1]) in _ClassDef):
+        # include the enclosing class scope in case we're in a def695 scope
+        end -= 1
+        direct_scopes.insert(0, heads[end])
     # more of less modeling what's described here.
     # https://github.com/gvanrossum/gvanrossum.github.io/blob/main/formal/scopesblog.md
-    other_scopes = [s for s in heads if type(s).__name__ in _ClosedScopes]
-    return [global_scope] + other_scopes + direct_scopes
-
-def _lookup(name, scopes, locals_map, only_live=True):
-    context = scopes[-1]
-    defs = []
-    for loc in locals_map.get(context, ()):
-        if loc.name() == name and (loc.islive if only_live else True):
-            defs.append(loc)
-    if defs:
-        return defs
-    elif len(scopes)==1:
-        raise LookupError()
-    return _lookup(name, scopes[:-1], locals_map)
+    scopes = [heads[0]]
+    scopes.extend(s for s in heads[1:end] if type(s) in _ClosedScopes)
+    scopes.extend(direct_scopes)
+    return scopes
+
+def _lookup(name, scopes, locals_map, only_live=True, names_map=None):
+    # returns an empty list if the name is not found.
+    # names_map, if given, holds the same locals as locals_map, grouped by
+    # name for each scope, so that they don't have to be scanned.
+    for context in reversed(scopes):
+        if names_map is None:
+            candidates = [loc for loc in locals_map.get(context, ())
+                          if loc.name() == name]
+        else:
+            candidates = names_map.get(context, {}).get(name, ())
+        if only_live:
+            defs = [loc for loc in candidates if loc.islive]
+        else:
+            defs = list(candidates)
+        if defs:
+            return defs
+        # enclosing scopes only provide live definitions
+        only_live = True
+    return []
 
 class UseDefChains(object):
     """
@@ -2092,16 +2542,25 @@ class UseDefChains(object):
     """
 
     def __init__(self, defuses):
-        self.chains = {}
+        self.chains = chains = {}
         for chain in defuses.chains.values():
-            if type(chain.node).__name__ == 'Name':
-                self.chains.setdefault(chain.node, [])
+            if type(chain.node) in _Name:
+                if chain.node not in chains:
+                    chains[chain.node] = []
             for use in chain.users():
-                self.chains.setdefault(use.node, []).append(chain)
+                defs = chains.get(use.node)
+                if defs is None:
+                    chains[use.node] = [chain]
+                else:
+                    defs.append(chain)
 
         for chain in defuses._builtins.values():
             for use in chain.users():
-                self.chains.setdefault(use.node, []).append(chain)
+                defs = chains.get(use.node)
+                if defs is None:
+                    chains[use.node] = [chain]
+                else:
+                    defs.append(chain)
 
     def __str__(self):
         out = []
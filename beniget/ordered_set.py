@@ -36,7 +36,7 @@ from typing import TYPE_CHECKING, MutableSet
 
 if TYPE_CHECKING:
     # trying to avoid polluting the global namespace with typing names.
-    from typing import TypeVar, Iterator, Iterable, Optional
+    from typing import TypeVar, Iterator, Iterable, Optional, Dict
     T = TypeVar("T")
 
 class ordered_set(MutableSet['T']):
@@ -49,6 +49,16 @@ class ordered_set(MutableSet['T']):
     def __init__(self, elements: 'Optional[Iterable[T]]' = None):
         self.values = OrderedDict.fromkeys(elements or [])
 
+    @classmethod
+    def _view(cls, values: 'Dict[T, None]') -> 'ordered_set[T]':
+        """
+        Returns an ordered_set backed by *values*, a dict whose keys are
+        the elements, without copying it.
+        """
+        self = cls.__new__(cls)
+        self.values = values
+        return self
+
     def add(self, x: 'T') -> None:
         self.values[x] = None
     
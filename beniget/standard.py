@@ -19,23 +19,21 @@ class DefUseChains(beniget.DefUseChains):
             # standard library nodes does not wrap 
             # the exception 'as' name in Name instance, so we use
             # the ExceptHandler instance as reference point.
-            dnode = self.chains.setdefault(node, beniget.Def(node))
+            dnode = self._chain_of(node)
             self.set_definition(node.name, dnode)
-            if dnode not in self.locals[self._scopes[-1]]:
-                self.locals[self._scopes[-1]].append(dnode)
+            self._add_local(self._scopes[-1], dnode)
         self.generic_visit(node)
     
     def visit_arg(self, node, skip_annotation=False):
-        dnode = self.chains.setdefault(node, beniget.Def(node))
+        dnode = self._chain_of(node)
         self.set_definition(node.arg, dnode)
-        if dnode not in self.locals[self._scopes[-1]]:
-            self.locals[self._scopes[-1]].append(dnode)
+        self._add_local(self._scopes[-1], dnode)
         if node.annotation is not None and not skip_annotation:
             self.visit(node.annotation)
         return dnode
     
     def visit_ExtSlice(self, node):
-        dnode = self.chains.setdefault(node, beniget.Def(node))
+        dnode = self._chain_of(node)
         for elt in node.dims:
             self.visit(elt).add_user(dnode)
         return dnode
@@ -49,13 +47,22 @@ class DefUseChains(beniget.DefUseChains):
 
 class UseDefChains(beniget.UseDefChains):
     def __init__(self, defuses):
-        self.chains = {}
+        self.chains = chains = {}
         for chain in defuses.chains.values():
             if isinstance(chain.node, (ast.Name, ast.arg)): # the only change is here
-                self.chains.setdefault(chain.node, [])
+                if chain.node not in chains:
+                    chains[chain.node] = []
             for use in chain.users():
-                self.chains.setdefault(use.node, []).append(chain)
+                defs = chains.get(use.node)
+                if defs is None:
+                    chains[use.node] = [chain]
+                else:
+                    defs.append(chain)
 
         for chain in defuses._builtins.values():
             for use in chain.users():
-                self.chains.setdefault(use.node, []).append(chain)
+                defs = chains.get(use.node)
+                if defs is None:
+                    chains[use.node] = [chain]
+                else:
+                    defs.append(chain)
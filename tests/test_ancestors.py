@@ -0,0 +1,70 @@
+from unittest import TestCase
+from textwrap import dedent
+import ast as _ast
+import gast as _gast
+
+import beniget
+
+
+class TestAncestors(TestCase):
+    ast = _gast
+
+    code = '''
+        import os
+        class C(object):
+            def f(self, x: int = 1, *, y=None) -> str:
+                global g
+                for i in range(x):
+                    if i and not y:
+                        return {k: v for k, v in os.environ.items()}[i]
+            async def g(self):
+                try:
+                    await self.f()
+                except (ValueError, TypeError) as e:
+                    raise e from None
+        '''
+
+    def reference_parents(self, module):
+        parents = {module: []}
+        todo = [module]
+        while todo:
+            node = todo.pop()
+            for child in self.ast.iter_child_nodes(node):
+                if isinstance(child, (_ast.expr_context, _gast.expr_context)):
+                    # the standard library shares context instances
+                    continue
+                parents[child] = parents[node] + [node]
+                todo.append(child)
+        return parents
+
+    def test_parents(self):
+        module = self.ast.parse(dedent(self.code))
+        ancestors = beniget.Ancestors()
+        ancestors.visit(module)
+        for node, parents in self.reference_parents(module).items():
+            self.assertEqual(ancestors.parents(node), parents)
+            if parents:
+                self.assertIs(ancestors.parent(node), parents[-1])
+        with self.assertRaises(IndexError):
+            ancestors.parent(module)
+
+    def test_parents_is_a_list(self):
+        module = self.ast.parse('def foo(x): return x')
+        ancestors = beniget.Ancestors()
+        ancestors.visit(module)
+        fn = module.body[0]
+        self.assertEqual(ancestors.parents(fn) + [fn], [module, fn])
+
+    def test_parent_instance(self):
+        module = self.ast.parse(dedent(self.code))
+        ancestors = beniget.Ancestors()
+        ancestors.visit(module)
+        ret = module.body[1].body[0].body[1].body[0].body[0]
+        self.assertIsInstance(ret, (_ast.Return, _gast.Return))
+        self.assertIs(ancestors.parentFunction(ret), module.body[1].body[0])
+        self.assertIs(ancestors.parentStmt(ret.value), ret)
+        with self.assertRaises(ValueError):
+            ancestors.parentInstance(ret, (_ast.Lambda, _gast.Lambda))
+
+class TestAncestorsStdlib(TestAncestors):
+    ast = _ast
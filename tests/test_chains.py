@@ -226,6 +226,23 @@ for _ in [1]:
             ['i -> (i -> ())',
              'i -> (i -> ())'])
 
+    def test_for_target_binds_twice(self):
+        code = "x = []\nfor a, _, _ in x:\n a"
+        mod, chains = self.checkChains(
+            code,
+            ['x -> (x -> ())',
+             'a -> (a -> ())',
+             '_ -> ()',
+             '_ -> ()'])
+        # the second round over the target kills both '_'
+        self.assertEqual([d.islive for d in chains.locals[mod]
+                          if d.name() == '_'],
+                         [False, False])
+
+    def test_star_resolved_name_in_loop(self):
+        code = "from m import *\nwhile 1:\n foo"
+        self.checkChains(code, ['* -> (foo -> ((#1)))'])
+
     def test_complex_for_orelse(self):
         code = "I = J = 0\nfor i in [1,2]:\n if i < 3: I = i\nelse:\n if 1: J = I\nJ"
         self.checkChains(
@@ -549,11 +566,56 @@ def outer():
             self.assertIn(expected, produced,
                           "actual message does not contains expected message")
 
+    def test_users_and_defs_are_indexable(self):
+        code = "x = 1\ny = 2\nx"
+        node = self.ast.parse(code)
+        found = []
+
+        class Recorder(getDefUseChainsType(node)):
+            def compute_defs(self, node, quiet=False):
+                defs = super().compute_defs(node, quiet=quiet)
+                found.append(defs[0])
+                return defs
+            defs = compute_defs
+
+        chains = Recorder()
+        chains.visit(node)
+        x_def = chains.chains[node.body[0].targets[0]]
+        y_def = chains.chains[node.body[1].targets[0]]
+        self.assertEqual(found, [x_def])
+        users = x_def.users()
+        self.assertIsInstance(users, beniget.ordered_set.ordered_set)
+        self.assertIs(users[0].node, node.body[2].value)
+        self.assertEqual(list(users + users), [users[0]])
+        self.assertEqual(len(y_def.users()), 0)
+
+    def test_visit_override_sees_statements(self):
+        code = "import os\nx = os.sep\nif x: y = 1"
+        node = self.ast.parse(code)
+        seen = []
+
+        class Recorder(getDefUseChainsType(node)):
+            def visit(self, node):
+                seen.append(type(node).__name__)
+                return super().visit(node)
+
+        Recorder().visit(node)
+        for name in ('Import', 'Assign', 'If', 'Attribute'):
+            self.assertIn(name, seen)
+
     def test_unbound_identifier_message_format(self):
         code = "foo(1)\nbar(2)"
         self.check_message(code, ["<unknown>:1", "<unknown>:2"])
         self.check_message(code, ["foo.py:1", "foo.py:2"], filename="foo.py")
 
+    def test_unbound_identifier_in_loop_message(self):
+        code = "for i in []:\n foo"
+        self.check_message(code, ["<unknown>:2", "<unknown>:2"])
+        code = "def f(a):\n for i in a:\n  lambda: foo"
+        self.check_message(code, ["<unknown>:3", "<unknown>:3"])
+        code = "from typing import TypeVar\nfor i in []:\n TypeVar('T', bound=Undef)"
+        self.check_message(code, ["x.pyi:3", "x.pyi:3"], filename="x.pyi")
+
     def test_unbound_class_variable_reference_message_format(self):
         code = "class A:\n a = 10\n def f(self): return a # a is undef"
         self.check_message(code, ["unbound identifier 'a' at <unknown>:3"])
@@ -759,6 +821,24 @@ if (a := a + a):
             code, ['a -> (a -> (BinOp -> (NamedExpr -> ())), a -> (BinOp -> (NamedExpr -> ())))', 'a -> ()']
         )
     
+    @skipIf(sys.version_info < (3, 8), 'Python 3.8 syntax')
+    def test_named_expr_in_dict_display(self):
+        # keys and values are evaluated pair by pair
+        code = 'd = {1: (y := 2), y: 3}'
+        self.checkChains(
+            code, ['y -> (y -> (Dict -> ()))', 'd -> ()']
+        )
+
+    def test_dict_display_users_order(self):
+        code = 'x = 1\nd = {1: x, x: 2}'
+        mod, chains = self.checkChains(
+            code, ['x -> (x -> (Dict -> ()), x -> (Dict -> ()))', 'd -> ()']
+        )
+        dict_node = mod.body[1].value
+        x_def = chains.chains[mod.body[0].targets[0]]
+        self.assertEqual([u.node for u in x_def.users()],
+                         [dict_node.values[0], dict_node.keys[1]])
+
     @skipIf(sys.version_info < (3, 8), 'Python 3.8 syntax')
     def test_named_expr_comprehension(self):
         # Warlus target should be stored in first non comprehension scope
@@ -849,9 +929,21 @@ class S:
         mod, chains = self.checkChains(
             code, ['annotations -> ()', 'S -> ()']
         )
-        self.assertEqual(chains.dump_chains(mod.body[1]), 
+        self.assertEqual(chains.dump_chains(mod.body[1]),
                          ['f -> (f -> (), f -> ())'])
-    
+
+    def test_comprehension_in_annotation_pep563(self):
+        code = '''
+from __future__ import annotations
+def f(x: [i for i in f], y: f): ...'''
+        mod, chains = self.checkChains(
+            code, ['annotations -> ()',
+                   'f -> (f -> (comprehension -> (ListComp -> ())), f -> ())']
+        )
+        self.assertEqual(
+            chains.dump_chains(mod.body[1].args.args[0].annotation),
+            ['i -> (i -> (ListComp -> ()))'])
+
     def test_import_dotted_name_binds_first_name(self):
         code = '''import collections.abc;collections;collections.abc'''
         self.checkChains(
@@ -1359,6 +1451,24 @@ LiteralValue: TypeAlias = list[LiteralValue]|object
                 strict=False,
             )
     
+    def test_stubs_forward_ref_imported_later_in_loop(self):
+        # TypeAlias is only recognized on the second round over the loop body
+        code = '''
+for i in []:
+    X: TypeAlias = Foo
+    from typing import TypeAlias
+class Foo: ...
+'''
+        self.checkChains(
+                code,
+                ['i -> ()',
+                 'X -> ()',
+                 'TypeAlias -> (TypeAlias -> ())',
+                 'Foo -> (Foo -> ())'],
+                is_stub=True,
+                strict=False,
+            )
+
     def test_stubs_typevar_forward_ref(self):
         code = '''
 from typing import TypeVar
@@ -2108,3 +2218,113 @@ class TestDefUseChainsUnderstandsFilename(TestCase):
             '/root/repos/beniget/beniget/__init__.pyi').is_package, True)
         self.assertEqual(beniget.DefUseChains(
             'beniget/beniget/', modname='beniget.__init__').is_package, True)
+
+class TestDefUseChainsDispatch(TestCase):
+    ast = _gast
+
+    def test_subclass_visitor_is_used(self):
+        node = self.ast.parse("a = 1; a + 2")
+        seen = []
+        class CountingDefUseChains(getDefUseChainsType(node)):
+            def visit_BinOp(self, node):
+                seen.append(node)
+                return super().visit_BinOp(node)
+        c = CountingDefUseChains()
+        c.visit(node)
+        self.assertEqual(len(seen), 1)
+        self.assertEqual(c.dump_chains(node), ["a -> (a -> (BinOp -> ()))"])
+
+        # the parent class dispatch table is not affected by the subclass
+        seen.clear()
+        getDefUseChainsType(node)().visit(node)
+        self.assertEqual(seen, [])
+
+class TestDefUseChainsDispatchStdlib(TestDefUseChainsDispatch):
+    ast = _ast
+
+class TestCollectFutureImports(TestCase):
+    ast = _gast
+
+    def checkFutureImports(self, code, ref):
+        from beniget.beniget import collect_future_imports
+        node = self.ast.parse(dedent(code))
+        self.assertEqual(collect_future_imports(node), ref)
+
+    def test_after_docstring(self):
+        code = '''
+            "doc"
+            from __future__ import annotations, division
+            from __future__ import generators
+            '''
+        self.checkFutureImports(code, {'annotations', 'division', 'generators'})
+
+    def test_stops_at_first_statement(self):
+        code = '''
+            from __future__ import annotations
+            import os
+            from __future__ import division
+            '''
+        self.checkFutureImports(code, {'annotations'})
+
+    def test_stops_at_non_string_expression(self):
+        code = '''
+            1
+            from __future__ import annotations
+            '''
+        self.checkFutureImports(code, set())
+
+    def test_relative_import(self):
+        code = '''
+            from .__future__ import annotations
+            '''
+        self.checkFutureImports(code, set())
+
+class TestCollectFutureImportsStdlib(TestCollectFutureImports):
+    ast = _ast
+
+class TestMatchesQualname(TestCase):
+    ast = _gast
+
+    def checkMatches(self, code, qnames, ref):
+        from beniget.beniget import matches_qualname
+        node = self.ast.parse(dedent(code))
+        c = getDefUseChainsType(node)(modname='mod')
+        c.visit(node)
+        expr = node.body[-1].value
+        self.assertEqual(matches_qualname([node], c.locals, c.imports,
+                                          c._modnames, expr, qnames), ref)
+
+    def test_imported_name(self):
+        code = '''
+            from typing import Optional
+            Optional
+            '''
+        self.checkMatches(code, {'typing.Optional'}, True)
+        self.checkMatches(code, {'typing_extensions.Optional'}, False)
+
+    def test_attribute(self):
+        code = '''
+            import typing as t
+            t.Optional
+            '''
+        self.checkMatches(code, {'typing.List', 'typing.Optional'}, True)
+        self.checkMatches(code, {'typing_extensions.Optional', 'typing.List'}, False)
+
+    def test_nested_attribute(self):
+        code = '''
+            import os.path
+            os.path.join
+            '''
+        self.checkMatches(code, {'os.path.join', 'os.path.split'}, True)
+        self.checkMatches(code, {'posixpath.join'}, False)
+
+    def test_local_name(self):
+        code = '''
+            class C: pass
+            C
+            '''
+        self.checkMatches(code, {'mod.C'}, True)
+        self.checkMatches(code, {'other.C'}, False)
+
+class TestMatchesQualnameStdlib(TestMatchesQualname):
+    ast = _ast